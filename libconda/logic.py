@@ -25,14 +25,278 @@ is probably best if you do not take advantage of this directly, but rather
 through the Require and Prevent functions.
 
 """
+from functools import reduce
 from itertools import chain, combinations
 from libconda.compat import iteritems, string_types
+import json
 import logging
+import os
+import pickle
+import random
+import weakref
 import pycosat
+from time import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
 dotlog = logging.getLogger('dotupdate')
 log = logging.getLogger(__name__)
 
+# The active SatTrace, if any
+_tracer = None
+
+
+class SatTrace(object):
+    """
+    Records every SAT call and every top-level clause generation call made
+    by any Clauses object while it is active. Use it as a context manager:
+
+        with SatTrace() as trace:
+            r.install(specs)
+        trace.to_json('trace.json')
+
+    Each record is a dictionary. SAT calls have kind 'sat', and record the
+    variable count, clause count, number of additional clauses, result
+    ('SAT', 'UNSAT', or 'UNKNOWN') and wall time in seconds. Clause
+    generation calls have kind 'eval', and record the function name, the
+    number of clauses and variables added, and the wall time. Both record
+    the phase attribute of the Clauses object at the time of the call.
+
+    Tracing is process-wide, and costs nothing when no trace is active.
+    """
+    def __init__(self):
+        self.records = []
+        self.depth = 0
+        self.prev = None
+
+    def __enter__(self):
+        global _tracer
+        self.prev = _tracer
+        _tracer = self
+        return self
+
+    def __exit__(self, *args):
+        global _tracer
+        _tracer = self.prev
+
+    def to_json(self, path=None):
+        """
+        Return the records as a JSON string, or write them to path.
+        """
+        if path is None:
+            return json.dumps(self.records, indent=2, sort_keys=True)
+        with open(path, 'w') as fo:
+            json.dump(self.records, fo, indent=2, sort_keys=True)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _portfolio_worker(conn, results, cancel, k, config):
+    # Runs in a child process, which keeps its own copy of the clauses.
+    # Each request carries the number of leading clauses of the copy that
+    # are still valid, and the clauses added after them. With a seed, each
+    # batch of new clauses is shuffled as it arrives; perm holds the index
+    # of each clause of the copy in the parent's list, and blocks the start
+    # of each batch, which is the same in both lists.
+    C = Clauses()
+    rng = random.Random(config.get('seed'))
+    perm = []
+    blocks = []
+
+    def interrupt():
+        # Give up as soon as the parent has moved on to another request
+        if cancel.value != seq:
+            raise _Cancelled()
+    C.interrupt = interrupt
+
+    while True:
+        msg = conn.recv_bytes()
+        if not msg:
+            return
+        seq, nkeep, new, state, method, args = pickle.loads(msg)
+        if nkeep < len(perm):
+            while blocks and blocks[-1] >= nkeep:
+                blocks.pop()
+            s = blocks[-1] if blocks else 0
+            tail = [(i, c) for i, c in zip(perm[s:], C.clauses[s:]) if i < nkeep]
+            del perm[s:], C.clauses[s:]
+            perm.extend(i for i, c in tail)
+            C.clauses.extend(c for i, c in tail)
+        if new:
+            batch = list(enumerate(new, nkeep))
+            if config.get('seed'):
+                rng.shuffle(batch)
+            blocks.append(nkeep)
+            perm.extend(i for i, c in batch)
+            C.clauses.extend(c for i, c in batch)
+        C.m, C.unsat, C.deadline, C.prop_limit = state
+        C.timed_out = False
+        C.push()
+        try:
+            if method == 'minimize':
+                bounds = []
+                res = C.stratified_(*args, strategy=config.get('strategy', 'bisect'),
+                                    bounds=bounds) + (bounds,)
+            else:
+                res = C.sat(*args)
+            results.put((seq, k, C.timed_out, res))
+        except _Cancelled:
+            pass
+        except Exception as e:
+            results.put((seq, k, None, repr(e)))
+        finally:
+            # An exception may leave the checkpoints of minimize behind
+            while C.stack:
+                C.pop()
+
+
+class Portfolio(object):
+    """
+    Runs each SAT call and minimization of a Clauses object as a race
+    between several solver configurations, each in its own process. The
+    first proven answer is used, and the other processes abandon the
+    request at their next SAT call. To enable it, set the portfolio
+    attribute of a Clauses object.
+
+    The processes are started on first use, and kept until close is
+    called. Each keeps a copy of the clauses, so only the clauses added
+    since the previous request are sent with each request. After a
+    minimization, the bounds on the objective that the winning process
+    kept are added to the clauses, exactly as the serial minimization
+    would add them. If every process fails, or dies, or none answers
+    within its deadline, None is returned, and the caller solves serially.
+
+    Each configuration is a dictionary. Its 'seed' entry, if nonzero,
+    shuffles the order of the clauses before solving, and its 'strategy'
+    entry is passed to minimize. By default, the configurations alternate
+    between the 'bisect' and 'linear' strategies with distinct seeds, one
+    per processor.
+
+    The encodings of AtMostOne and ExactlyOne are fixed when the clauses
+    are generated, so they cannot vary between the configurations.
+    """
+    # Seconds between checks that the processes are still alive
+    poll = 1.0
+    # Seconds past the deadline of a request to wait for an answer
+    grace = 5.0
+
+    def __init__(self, configs=None, processes=None):
+        if configs is None:
+            import multiprocessing
+            nproc = processes or multiprocessing.cpu_count()
+            configs = [{'seed': k, 'strategy': ('bisect', 'linear')[k % 2]}
+                       for k in range(nproc)]
+        self.configs = configs
+        self.procs = None
+        self.owner = None
+        self.seq = 0
+
+    def __getstate__(self):
+        return {'configs': self.configs}
+
+    def __setstate__(self, state):
+        self.__init__(state['configs'])
+
+    def start_(self):
+        import multiprocessing
+        self.results = multiprocessing.Queue()
+        self.cancel = multiprocessing.Value('l', 0, lock=False)
+        self.conns = []
+        self.procs = []
+        for k, config in enumerate(self.configs):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_portfolio_worker,
+                                           args=(child, self.results, self.cancel, k, config))
+            proc.daemon = True
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+        self.owner = None
+
+    def close(self):
+        """
+        Stop the processes. They are started again if needed.
+        """
+        if self.procs is None:
+            return
+        # Busy processes give up their request at their next SAT call
+        self.cancel.value = 0
+        for conn, proc in zip(self.conns, self.procs):
+            try:
+                conn.send_bytes(b'')
+            except (IOError, OSError):
+                pass
+            proc.join(self.poll)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self.procs = self.owner = None
+
+    def run(self, C, method, args):
+        """
+        Call C.method(*args) for each configuration, and return a tuple
+        (timed_out, result) for the first that finishes without timing out,
+        or for the last one if they all do. For 'minimize', the method is
+        C.stratified_, whose result is extended with the bounds it kept.
+        Return None if no configuration produced an answer.
+        """
+        if self.procs is None or not all(proc.is_alive() for proc in self.procs):
+            self.close()
+            self.start_()
+        # C.synced is the number of leading clauses that the processes
+        # already have, if they have the clauses of C at all
+        owner = self.owner and self.owner()
+        nkeep = C.synced if owner is C else 0
+        self.owner = weakref.ref(C)
+        C.synced = len(C.clauses)
+        self.seq += 1
+        self.cancel.value = self.seq
+        msg = pickle.dumps((self.seq, nkeep, C.clauses[nkeep:],
+                            (C.m, C.unsat, C.deadline, C.prop_limit), method, args), -1)
+        for conn in self.conns:
+            conn.send_bytes(msg)
+        try:
+            errors = []
+            result = None
+            pending = set(range(len(self.procs)))
+            while pending:
+                if C.deadline is not None and time() > C.deadline + self.grace:
+                    errors.append('no answer by the deadline')
+                    break
+                try:
+                    seq, k, timed_out, res = self.results.get(timeout=self.poll)
+                except queue.Empty:
+                    if not any(self.procs[k].is_alive() for k in pending):
+                        errors.append('the processes died')
+                        break
+                    continue
+                if seq != self.seq:
+                    continue
+                pending.discard(k)
+                if timed_out is None:
+                    errors.append(res)
+                elif not timed_out:
+                    log.debug('Portfolio: configuration %r finished first' %
+                              (self.configs[k],))
+                    return False, res
+                else:
+                    result = True, res
+            if result is None:
+                log.debug('Portfolio failed (%s); solving serially' % ', '.join(errors))
+                # The processes may be in any state; start over next time
+                self.close()
+            return result
+        finally:
+            self.cancel.value = 0
+
 
 # Code that uses special cases (generates no clauses) is in ADTs/FEnv.h in
 # minisatp. Code that generates clauses is in Hardware_clausify.cc (and are
@@ -41,20 +305,74 @@ log = logging.getLogger(__name__)
 class Clauses(object):
     def __init__(self, m=0):
         self.clauses = []
+        # names maps each variable name to its literal; indices maps each
+        # variable number to its name. Negated names ('!' + name) are not
+        # stored, but computed on lookup.
         self.names = {}
-        self.indices = {}
+        self.indices = [None]
         self.unsat = False
         self.m = m
+        self.dimacs_dir = None
+        self.nsat = 0
+        self.phase = None
+        self.deadline = None
+        self.timed_out = False
+        self.prop_limit = 100000
+        self.stack = []
+        self.journal = []
+        self.portfolio = None
+        self.interrupt = None
+        # The number of leading clauses that the portfolio processes have
+        self.synced = 0
 
     def name_var(self, m, name):
-        nname = '!' + name
+        if self.stack:
+            # Remember the previous value of the entry, so pop can restore it
+            self.journal.append((self.names, name, self.names.get(name)))
         self.names[name] = m
-        self.names[nname] = -m
-        if type(m) is not bool and m not in self.indices:
-            self.indices[m] = name
-            self.indices[-m] = nname
+        if type(m) is not bool:
+            k = abs(m)
+            if k >= len(self.indices):
+                self.indices.extend([None] * (k + 1 - len(self.indices)))
+            if self.indices[k] is None:
+                if self.stack:
+                    self.journal.append((self.indices, k, None))
+                self.indices[k] = name if m > 0 else '!' + name
         return m
 
+    def push(self):
+        """
+        Save a checkpoint of the clause set: the clauses, the variable count,
+        the variable names, and the unsat flag. Checkpoints can be nested.
+        """
+        self.stack.append((len(self.clauses), self.m, self.unsat, len(self.journal)))
+
+    def pop(self, restore=True):
+        """
+        Remove the most recent checkpoint. If restore is True, first roll the
+        clause set back to it, in time proportional to what was added since.
+        Otherwise, the changes are kept.
+        """
+        nz, m, unsat, nj = self.stack.pop()
+        if not restore:
+            if not self.stack:
+                del self.journal[:]
+            return
+        del self.clauses[nz:]
+        self.synced = min(self.synced, nz)
+        del self.indices[m + 1:]
+        self.m = m
+        self.unsat = unsat
+        while len(self.journal) > nj:
+            d, key, val = self.journal.pop()
+            if d is self.indices:
+                if key <= m:
+                    d[key] = val
+            elif val is None:
+                d.pop(key, None)
+            else:
+                d[key] = val
+
     def new_var(self, name=None):
         m = self.m + 1
         self.m = m
@@ -63,13 +381,78 @@ class Clauses(object):
         return m
 
     def from_name(self, name):
-        return self.names.get(name)
+        m = self.names.get(name)
+        if m is None and name[:1] == '!':
+            m = self.names.get(name[1:])
+            if m is not None:
+                m = -m
+        return m
 
     def from_index(self, m):
-        return self.indices.get(m)
+        k = abs(m)
+        name = self.indices[k] if k < len(self.indices) else None
+        if name is None or m > 0:
+            return name
+        return name[1:] if name[0] == '!' else '!' + name
 
     def varnum(self, x):
-        return self.names[x] if isinstance(x, string_types) else x
+        if isinstance(x, string_types):
+            m = self.from_name(x)
+            if m is None:
+                raise KeyError(x)
+            return m
+        return x
+
+    def to_dimacs(self, path, additional=None, names=True):
+        """
+        Write the current clause set, plus any additional clauses, to path
+        in DIMACS CNF format. If names is True, the variable names are
+        written as comment lines of the form "c name <literal> <name>", so
+        that from_dimacs can restore them.
+        """
+        additional = [tuple(map(self.varnum, c)) for c in additional or ()]
+        with open(path, 'w') as fo:
+            if names:
+                for name, m in iteritems(self.names):
+                    if name[0] != '!':
+                        fo.write('c name %d %s\n' % (m, name))
+            fo.write('p cnf %d %d\n' % (self.m, len(self.clauses) + len(additional) +
+                                        bool(self.unsat)))
+            for clause in chain(self.clauses, additional):
+                fo.write(' '.join(map(str, clause)) + ' 0\n')
+            if self.unsat:
+                fo.write('0\n')
+
+    @classmethod
+    def from_dimacs(cls, path):
+        """
+        Read a Clauses object from a DIMACS CNF file, such as one written by
+        to_dimacs, including any variable names stored in its comments.
+        """
+        self = cls()
+        clause = []
+        with open(path) as fi:
+            for line in fi:
+                if line.startswith('c'):
+                    parts = line.rstrip('\n').split(' ', 3)
+                    if len(parts) == 4 and parts[1] == 'name':
+                        self.name_var(int(parts[2]), parts[3])
+                    continue
+                if line.startswith('p'):
+                    self.m = max(self.m, int(line.split()[2]))
+                    continue
+                for lit in map(int, line.split()):
+                    if lit:
+                        clause.append(lit)
+                        self.m = max(self.m, abs(lit))
+                    elif clause:
+                        self.clauses.append(tuple(clause))
+                        clause = []
+                    else:
+                        self.unsat = True
+        if clause:
+            self.clauses.append(tuple(clause))
+        return self
 
     def Assign_(self, vals, name=None):
         tvals = type(vals)
@@ -86,13 +469,26 @@ class Clauses(object):
 
     def Convert_(self, x):
         if isinstance(x, string_types):
-            return self.names[x]
+            return self.varnum(x)
         tx = type(x)
         if tx in (tuple, list):
             return tx(map(self.Convert_, x))
         return x
 
     def Eval_(self, func, args, polarity, name, conv=True):
+        tracer = _tracer
+        if tracer is not None and not tracer.depth:
+            # Only the outermost call is timed; the nested ones are part of it
+            m0, nz, t0 = self.m, len(self.clauses), time()
+            tracer.depth += 1
+            try:
+                return self.Eval_(func, args, polarity, name, conv)
+            finally:
+                tracer.depth -= 1
+                tracer.records.append({
+                    'kind': 'eval', 'phase': self.phase, 'func': func.__name__,
+                    'clauses_added': len(self.clauses) - nz,
+                    'vars_added': self.m - m0, 'time': time() - t0})
         if conv:
             args = self.Convert_(args)
         nz = len(self.clauses)
@@ -106,7 +502,7 @@ class Clauses(object):
         elif tvals is not bool:
             self.clauses.append((vals if polarity else -vals,))
         else:
-            self.clauses = self.clauses[:nz]
+            del self.clauses[nz:]
             self.unsat = self.unsat or polarity != vals
 
     def Combine_(self, args, polarity):
@@ -407,7 +803,16 @@ class Clauses(object):
         Returned is the list of those solutions.  When the clauses are
         unsatisfiable, an empty list is returned.
 
+        If the deadline attribute is set to a time.time() value and no limit
+        is given, the solver gives up at about that time, returns None, and
+        sets the timed_out attribute. If the portfolio attribute is set and
+        no limit is given, the Portfolio object is used to solve. If the
+        interrupt attribute is set, it is called before each SAT call, and
+        may raise an exception to abandon the search.
+
         """
+        if self.interrupt is not None:
+            self.interrupt()
         if self.unsat:
             return None
         if not self.m:
@@ -417,8 +822,55 @@ class Clauses(object):
             clauses = chain(self.clauses, additional)
         else:
             clauses = self.clauses
+        self.nsat += 1
+        if self.dimacs_dir:
+            self.to_dimacs(os.path.join(self.dimacs_dir, 'sat%04d.cnf' % self.nsat),
+                           additional)
+        tracer = _tracer
+        if tracer is not None:
+            t0 = time()
+        res = None
+        if self.portfolio is not None and not limit:
+            res = self.portfolio.run(self, 'sat', (additional,))
+        if res is not None:
+            timed_out, solution = res
+            if solution is None:
+                solution = "UNKNOWN" if timed_out else "UNSAT"
+                self.timed_out = self.timed_out or timed_out
+        elif self.deadline is None or limit:
+            solution = self.solve_(clauses, additional, limit)
+        else:
+            # Solve with increasing propagation limits until we get an
+            # answer or run out of time. pycosat cannot be interrupted, so
+            # the deadline may be overrun by the length of one attempt.
+            clauses = list(clauses)
+            solution = "UNKNOWN"
+            limit = self.prop_limit
+            while time() < self.deadline:
+                solution = self.solve_(clauses, additional, limit)
+                if solution != "UNKNOWN":
+                    break
+                limit *= 2
+            if solution == "UNKNOWN":
+                log.debug('SAT call timed out')
+                self.timed_out = True
+        if tracer is not None:
+            tracer.records.append({
+                'kind': 'sat', 'phase': self.phase, 'vars': self.m,
+                'clauses': len(self.clauses), 'additional': len(additional or ()),
+                'result': solution if solution in ("UNSAT", "UNKNOWN") else 'SAT',
+                'time': time() - t0})
+        if solution in ("UNSAT", "UNKNOWN"):
+            return None
+        if additional and includeIf:
+            self.clauses.extend(additional)
+        if names:
+            return set(nm for nm in (self.from_index(s) for s in solution) if nm and nm[0] != '!')
+        return solution
+
+    def solve_(self, clauses, additional, limit):
         try:
-            solution = pycosat.solve(clauses, vars=self.m, prop_limit=limit)
+            return pycosat.solve(clauses, vars=self.m, prop_limit=limit)
         except TypeError:
             # pycosat 0.6.1 should not require this; pycosat 0.6.0 did, but we
             # have made conda dependent on pycosat 0.6.1. However, issue #2276
@@ -426,37 +878,79 @@ class Clauses(object):
             # pycosat 0.6.1 is installed. Until we can understand why, this
             # needs to stay. I still don't want to invoke it unnecessarily,
             # because for large clauses lists it is slow.
-            clauses = list(map(list, clauses))
-            solution = pycosat.solve(clauses, vars=self.m, prop_limit=limit)
-        if solution in ("UNSAT", "UNKNOWN"):
-            return None
-        if additional and includeIf:
-            self.clauses.extend(additional)
-        if names:
-            return set(nm for nm in (self.indices.get(s) for s in solution) if nm and nm[0] != '!')
-        return solution
+            clauses = list(map(list, chain(self.clauses, additional or ())))
+            return pycosat.solve(clauses, vars=self.m, prop_limit=limit)
 
-    def itersolve(self, constraints=None, m=None):
-        exclude = []
-        if m is None:
+    def itersolve(self, constraints=None, m=None, project=None, limit=0,
+                  exact=False):
+        """
+        Iterate over the SAT solutions for the current clause set, plus the
+        given constraints.
+
+        Each solution is excluded from further consideration by a blocking
+        clause over the variables 1..m (default: all variables). If project
+        is given, the solutions are instead projected onto that collection
+        of variables (integers or names), and each one is blocked by a
+        clause over those of them that are true; so no solution is produced
+        whose true projected variables include those of an earlier one. If
+        exact is also True, the blocking clause covers the false projected
+        variables as well, and exactly one solution is produced for each
+        distinct assignment to them.
+
+        If limit is nonzero, no more than limit solutions are produced.
+        Since this is a generator, callers that only need to know whether
+        there is more than one solution can simply stop after the second.
+        The constraints and blocking clauses are only added to the clause
+        set for the duration of each SAT call, so it is left untouched
+        while the iteration is suspended.
+        """
+        if project is not None:
+            project = set(abs(self.varnum(k)) for k in project)
+            if not project:
+                # Every solution has the same (empty) projection
+                limit = 1
+        elif m is None:
             m = self.m
-        while True:
+        exclude = [tuple(map(self.varnum, c)) for c in constraints or ()]
+        nsol = 0
+        while not limit or nsol < limit:
             # We don't use pycosat.itersolve because it is more
             # important to limit the number of terms added to the
             # exclusion list, in our experience. Once we update
             # pycosat to do this, this can use it.
-            sol = self.sat(chain(constraints, exclude))
+            self.push()
+            self.clauses.extend(exclude)
+            try:
+                sol = self.sat()
+            finally:
+                self.pop()
             if sol is None:
                 return
             yield sol
-            exclude.append([-k for k in sol if -m <= k <= m])
+            nsol += 1
+            if project is None:
+                exclude.append(tuple(-k for k in sol if -m <= k <= m))
+            elif exact:
+                exclude.append(tuple(-k for k in sol if abs(k) in project))
+            else:
+                exclude.append(tuple(-k for k in sol if k in project))
 
-    def minimize(self, objective, bestsol, trymax=False):
+    def minimize(self, objective, bestsol, trymax=False, strategy='bisect'):
         """
         Minimize the objective function given either by (coeff, integer)
         tuple pairs, or a dictionary of varname: coeff values. The actual
         minimization is multiobjective: first, we minimize the largest
         active coefficient value, then we minimize the sum.
+
+        The strategy is either 'bisect', which bisects the range of possible
+        values, or 'linear', which asks for a solution just better than the
+        best one found so far. If the portfolio attribute is set, the
+        minimization is run by the Portfolio object instead, and the bounds
+        on the objective that it kept are added to the clauses.
+
+        If a SAT call times out (see sat), the best solution found so far
+        is returned, the objective is constrained to be no worse than its
+        value, and the timed_out attribute is left set.
         """
         if not objective:
             log.debug('Empty objective, trivial solution')
@@ -469,17 +963,104 @@ class Clauses(object):
             objective = [(v, self.varnum(k)) for k, v in iteritems(objective)]
 
         objective, offset = self.LB_Preprocess_(objective)
+
+        if self.portfolio is not None:
+            res = self.portfolio.run(self, 'minimize', (objective, bestsol, trymax))
+            if res is not None:
+                timed_out, (bestsol, bestval, bounds) = res
+                self.timed_out = self.timed_out or timed_out
+                for bound in bounds:
+                    self.bound_(*bound)
+                return bestsol, bestval
+
+        return self.stratified_(objective, bestsol, trymax, strategy)
+
+    def stratified_(self, objective, bestsol, trymax, strategy, bounds=None):
+        """
+        Minimize a preprocessed objective. If bounds is a list, the
+        arguments of each call to bound_ whose clauses are kept are
+        appended to it.
+        """
+        # Split the objective into strata that can be minimized one at a
+        # time, and divide each by the greatest common divisor of its
+        # coefficients, which shrinks the LinearBound encodings.
         maxval = max(c for c, a in objective)
+        strata = self.stratify_(objective)
+        if len(strata) > 1:
+            log.debug('Objective split into %d strata' % len(strata))
+        total = 0
+        peak = maxval > 1
+        for stratum in strata:
+            g = reduce(gcd, (c for c, a in stratum))
+            if g > 1:
+                stratum = [(c // g, a) for c, a in stratum]
+            bestsol, bestval = self.minimize_(stratum, bestsol, trymax, strategy, peak,
+                                              bounds)
+            total += g * bestval
+            if bestval:
+                # The peak lies in this stratum, so the lower strata only
+                # need their sums minimized.
+                peak = False
+        return bestsol, total
+
+    def stratify_(self, objective):
+        """
+        Split a preprocessed objective into strata, from the highest
+        coefficients to the lowest, such that minimizing each stratum in
+        turn minimizes the whole objective. This is true when the gcd of
+        the coefficients above each boundary exceeds the sum of those below
+        it, since then no change below the boundary can make up for a
+        change above it.
+        """
+        terms = sorted(objective)
+        strata = []
+        lsum = 0
+        bounds = []
+        for k in range(1, len(terms)):
+            lsum += terms[k-1][0]
+            if terms[k][0] != terms[k-1][0]:
+                bounds.append((k, lsum))
+        hgcd = 0
+        hi = len(terms)
+        for k, lsum in reversed(bounds):
+            hgcd = reduce(gcd, (c for c, a in terms[k:hi]), hgcd)
+            if hgcd > lsum:
+                strata.append(terms[k:hi])
+                hi = k
+        strata.append(terms[:hi])
+        return strata
+
+    def bound_(self, objective, peak, lo, hi):
+        """
+        Constrain the objective to lie between lo and hi. If peak is True,
+        this bounds its peak, the largest active coefficient, instead of
+        its sum; a nonzero lo must then be one of the coefficients.
+        """
+        if peak:
+            self.Prevent(self.Any, tuple(a for c, a in objective if c > hi))
+            # Since we know the peak is at least lo, one of the terms
+            # between lo and hi is active
+            temp = tuple(a for c, a in objective if lo <= c <= hi)
+            if lo and temp:
+                self.Require(self.Any, temp)
+        else:
+            self.Require(self.LinearBound, objective, lo, hi, False)
 
+    def minimize_(self, objective, bestsol, trymax, strategy, peak, bounds=None):
         def peak_val(sol, odict):
             return max(odict.get(s, 0) for s in sol)
 
         def sum_val(sol, odict):
             return sum(odict.get(s, 0) for s in sol)
 
+        # The peak can only take the values of the coefficients (or zero),
+        # so the peak minimization bisects over their ranks instead.
+        levels = [0] + sorted(set(c for c, a in objective))
+        ranks = {c: k for k, c in enumerate(levels)}
+
         lo = 0
         try0 = 0
-        for peak in ((True, False) if maxval > 1 else (False,)):
+        for peak in ((True, False) if peak else (False,)):
             if peak:
                 log.debug('Beginning peak minimization')
                 objval = peak_val
@@ -492,28 +1073,39 @@ class Clauses(object):
 
             # If we got lucky and the initial solution is optimal, we still
             # need to generate the constraints at least once
-            hi = bestval
-            m_orig = self.m
+            hi = ranks[bestval] if peak else bestval
             nz = len(self.clauses)
             if trymax and not peak:
                 try0 = hi - 1
 
             log.debug("Initial range (%d,%d)" % (lo, hi))
             while True:
-                if try0 is None:
-                    mid = (lo+hi) // 2
-                else:
+                if try0 is not None:
                     mid = try0
+                elif strategy == 'linear':
+                    mid = max(lo, hi - 1)
+                else:
+                    mid = (lo+hi) // 2
+                self.push()
                 if peak:
-                    self.Prevent(self.Any, tuple(a for c, a in objective if c > mid))
-                    temp = tuple(a for c, a in objective if lo <= c <= mid)
-                    if temp:
-                        self.Require(self.Any, temp)
+                    bound = (objective, True, levels[lo], levels[mid])
                 else:
-                    self.Require(self.LinearBound, objective, lo, mid, False)
+                    bound = (objective, False, lo, mid)
+                self.bound_(*bound)
                 log.debug('Bisection attempt: (%d,%d), (%d+%d) clauses' %
                           (lo, mid, nz, len(self.clauses)-nz))
                 newsol = self.sat()
+                if newsol is None and self.timed_out:
+                    # Keep the incumbent, and bound the objective by its
+                    # value so that later objectives cannot trade it away.
+                    self.pop()
+                    bound = (objective, peak, 0, bestval)
+                    self.bound_(*bound)
+                    if bounds is not None:
+                        bounds.append(bound)
+                    log.debug('Timed out, final %s objective: %d' %
+                              ('peak' if peak else 'sum', bestval))
+                    return bestsol, sum_val(bestsol, odict)
                 if newsol is None:
                     lo = mid + 1
                     log.debug("Bisection failure, new range=(%d,%d)" % (lo, hi))
@@ -524,14 +1116,14 @@ class Clauses(object):
                     done = lo == mid
                     bestsol = newsol
                     bestval = objval(newsol, odict)
-                    hi = bestval
+                    hi = ranks[bestval] if peak else bestval
                     log.debug("Bisection success, new range=(%d,%d)" % (lo, hi))
                     if done:
+                        self.pop(restore=False)
+                        if bounds is not None:
+                            bounds.append(bound)
                         break
-                self.m = m_orig
-                if len(self.clauses) > nz:
-                    self.clauses = self.clauses[:nz]
-                self.unsat = False
+                self.pop()
                 try0 = None
 
             log.debug('Final %s objective: %d' % ('peak' if peak else 'sum', bestval))
@@ -557,7 +1149,8 @@ def evaluate_eq(eq, sol):
     return sum(eq.get(s, 0) for s in sol if type(s) is not bool)
 
 
-def minimal_unsatisfiable_subset(clauses, sat, log=False):
+def minimal_unsatisfiable_subset(clauses, sat, log=False, method='bisect',
+                                 stats=None, pool=None):
     """
     Given a set of clauses, find a minimal unsatisfiable subset (an
     unsatisfiable core)
@@ -573,6 +1166,26 @@ def minimal_unsatisfiable_subset(clauses, sat, log=False):
     work with any order-reversing function (reversing the order of subset and
     the order False < True), that is, any function where (A <= B) iff (sat(B)
     <= sat(A)), where A <= B means A is a subset of B and False < True).
+    Because only the subset matters, the result of each probe is memoized,
+    and sat is never called twice on the same subset.
+
+    method selects the search strategy: 'bisect' (the default) or
+    'quickxplain'. Both return a minimal unsatisfiable subset, though not
+    necessarily the same one.
+
+    If stats is a dictionary, it is updated with the number of calls made
+    to sat ('probes') and the number of probes answered from the memo
+    ('cached').
+
+    If pool is given, it must provide a map(func, iterable) method, like
+    multiprocessing.Pool, and sat must be picklable. The two halves
+    examined at each step of the 'bisect' search are then probed
+    concurrently, so no more than two of its workers are ever busy and the
+    search is at most twice as fast as the serial one. The result is
+    identical to that of the serial search, although a few more probes may
+    be made, as both halves are probed even when the first one would have
+    been enough. The 'quickxplain' search probes strictly sequentially and
+    ignores the pool.
 
     Algorithm
     =========
@@ -594,7 +1207,15 @@ def minimal_unsatisfiable_subset(clauses, sat, log=False):
     {c} is a strict subset of B*, contradicting B* being the minimal subset of
     B with this property.
 
+    The QuickXplain variant (Junker, "QuickXplain: Preferred Explanations and
+    Relaxations for Over-Constrained Problems," AAAI 2004) splits the same
+    way, but skips the probe of a background set whenever nothing was added
+    to it since the last probe. It tends to need fewer probes when the core
+    is small relative to the number of clauses.
+
     """
+    if method not in ('bisect', 'quickxplain'):
+        raise ValueError("Unknown method: %r" % (method,))
     if log:
         from libconda.console import setup_verbose_handlers
         setup_verbose_handlers()
@@ -606,59 +1227,105 @@ def minimal_unsatisfiable_subset(clauses, sat, log=False):
         update = lambda x, y: None
         stop = lambda: None
 
+    # The search itself runs on tuples of indices into clauses, so that
+    # probe results can be memoized even if the clauses are not hashable.
     clauses = tuple(clauses)
-    if sat(clauses):
-        raise ValueError("Clauses are not unsatisfiable")
+    L = len(clauses)
+    memo = {}
+    counts = {'probes': 0, 'cached': 0, 'done': 0}
+
+    def probe(S):
+        key = frozenset(S)
+        res = memo.get(key)
+        if res is None:
+            counts['probes'] += 1
+            res = memo[key] = bool(sat(tuple(clauses[k] for k in sorted(key))))
+        else:
+            counts['cached'] += 1
+        return res
+
+    def probe_both(S1, S2):
+        # Probe S1 and S2 on the pool, unless one of them is already known
+        todo = [frozenset(S) for S in (S1, S2)]
+        todo = [key for key in todo if key not in memo]
+        if len(todo) == 2:
+            counts['probes'] += 2
+            args = [tuple(clauses[k] for k in sorted(key)) for key in todo]
+            for key, res in zip(todo, pool.map(sat, args)):
+                memo[key] = bool(res)
+
+    def discard(S):
+        # To display progress, every time we discard clauses, we update the
+        # progress by that much.
+        counts['done'] += len(S)
+        update(counts['done'], L)
 
     def split(S):
         """
         Split S into two equal parts
         """
-        S = tuple(S)
-        L = len(S)
-        return S[:L//2], S[L//2:]
+        N = len(S)
+        return S[:N//2], S[N//2:]
 
-    def minimal_unsat(clauses, include=()):
+    def minimal_unsat(S, include=()):
         """
-        Return a minimal subset A of clauses such that A + include is
+        Return a minimal subset A of S such that A + include is
         unsatisfiable.
 
-        Implicitly assumes that clauses + include is unsatisfiable.
+        Implicitly assumes that S + include is unsatisfiable.
         """
-        global L, d
-
-        # assert not sat(clauses + include), (len(clauses), len(include))
-
-        # Base case: Since clauses + include is implicitly assumed to be
-        # unsatisfiable, if clauses has only one element, it must be its own
+        # Base case: Since S + include is implicitly assumed to be
+        # unsatisfiable, if S has only one element, it must be its own
         # minimal subset
-        if len(clauses) == 1:
-            return clauses
+        if len(S) == 1:
+            return S
 
-        A, B = split(clauses)
+        A, B = split(S)
 
         # If one half is unsatisfiable (with include), we can discard the
         # other half.
-
-        # To display progress, every time we discard clauses, we update the
-        # progress by that much.
-        if not sat(A + include):
-            d += len(B)
-            update(d, L)
+        if pool is not None:
+            probe_both(A + include, B + include)
+        if not probe(A + include):
+            discard(B)
             return minimal_unsat(A, include)
-        if not sat(B + include):
-            d += len(A)
-            update(d, L)
+        if not probe(B + include):
+            discard(A)
             return minimal_unsat(B, include)
 
         Astar = minimal_unsat(A, B + include)
         Bstar = minimal_unsat(B, Astar + include)
         return Astar + Bstar
 
-    global L, d
-    L = len(clauses)
-    d = 0
+    def quickxplain(S, include=(), added=False):
+        """
+        Return a minimal subset A of S such that A + include is
+        unsatisfiable, or an empty tuple if include is unsatisfiable by
+        itself. include is only probed if added is True.
+        """
+        if added and not probe(include):
+            discard(S)
+            return ()
+        if len(S) == 1:
+            return S
+        A, B = split(S)
+        Bstar = quickxplain(B, include + A, bool(A))
+        Astar = quickxplain(A, include + Bstar, bool(Bstar))
+        return Astar + Bstar
+
+    if probe(tuple(range(L))):
+        raise ValueError("Clauses are not unsatisfiable")
+
     start(L)
-    ret = minimal_unsat(clauses)
+    if method == 'bisect':
+        ret = minimal_unsat(tuple(range(L)))
+    else:
+        ret = quickxplain(tuple(range(L)))
     stop()
-    return ret
+    logging.getLogger(__name__).debug(
+        'Unsatisfiable core: %d/%d clauses, %d probes (%d cached)' %
+        (len(ret), L, counts['probes'], counts['cached']))
+    if stats is not None:
+        stats['probes'] = counts['probes']
+        stats['cached'] = counts['cached']
+    return tuple(clauses[k] for k in ret)
@@ -1,8 +1,17 @@
 from __future__ import print_function, division, absolute_import
 
+import hashlib
+import json
 import logging
+import os
+import tempfile
 from collections import defaultdict
 from itertools import chain
+from time import time
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
 
 from libconda.compat import iterkeys, itervalues, iteritems, string_types
 from libconda.logic import minimal_unsatisfiable_subset, Clauses
@@ -22,6 +31,18 @@ def dashlist(iter):
     return ''.join('\n  - ' + str(x) for x in iter)
 
 
+def _restore_error(cls, args, state):
+    e = cls.__new__(cls, *args)
+    e.__dict__.update(state)
+    return e
+
+
+def _reduce_error(self):
+    # The constructors below take the raw conflict data, not the message,
+    # so the default pickling, which calls them with self.args, fails.
+    return _restore_error, (type(self), self.args, self.__dict__)
+
+
 class Unsatisfiable(RuntimeError):
     '''An exception to report unsatisfiable dependencies.
 
@@ -76,6 +97,8 @@ Use "conda info <package>" to see the dependencies for each package.'''
         msg = msg % dashlist(bad_deps)
         super(Unsatisfiable, self).__init__(msg)
 
+    __reduce__ = _reduce_error
+
 
 class NoPackagesFound(RuntimeError):
     '''An exception to report that requested packages are missing.
@@ -101,6 +124,39 @@ class NoPackagesFound(RuntimeError):
         super(NoPackagesFound, self).__init__(msg)
         self.pkgs = deps
 
+    __reduce__ = _reduce_error
+
+
+class SolveTimeout(RuntimeError):
+    '''An exception to report that no solution could be found within the
+    time budget of a solve.
+    '''
+    def __init__(self, time_budget):
+        msg = 'No solution was found within the time budget of %gs' % time_budget
+        super(SolveTimeout, self).__init__(msg)
+
+    __reduce__ = _reduce_error
+
+
+class SolveCancelled(RuntimeError):
+    '''An exception to report that a solve was cancelled before it finished.
+    '''
+    def __init__(self):
+        super(SolveCancelled, self).__init__('The solve was cancelled')
+
+    __reduce__ = _reduce_error
+
+
+class Solution(list):
+    """The result of a solve: a list of package filenames, or with
+    returnall, a list of such lists. Its unproven attribute lists the
+    objectives that the time budget did not allow to be proven optimal;
+    it is empty unless a time budget ran out.
+    """
+    def __init__(self, pkgs=(), unproven=()):
+        super(Solution, self).__init__(pkgs)
+        self.unproven = list(unproven)
+
 
 class MatchSpec(object):
     def __new__(cls, spec, target=None, optional=False, negate=False):
@@ -153,6 +209,9 @@ class MatchSpec(object):
     def __hash__(self):
         return hash((self.spec, self.negate))
 
+    def __reduce__(self):
+        return MatchSpec, (self.spec, self.target, self.optional, self.negate)
+
     def __repr__(self):
         res = 'MatchSpec(' + repr(self.spec)
         if self.target:
@@ -241,8 +300,233 @@ def build_groups(index):
     return groups, trackers
 
 
+_profiler = None
+
+
+def _profile(name, C=None):
+    if _profiler is not None:
+        _profiler.start(name, C)
+
+
+def _profile_objective(value):
+    if _profiler is not None:
+        _profiler.objective(value)
+
+
+def _profile_stop(C=None):
+    if _profiler is not None:
+        _profiler.stop(C)
+
+
+class SolveProfile(object):
+    """Records the time spent in each phase of every solve made while it
+    is active. Use it as a context manager:
+
+        with SolveProfile() as profile:
+            r.install(specs)
+        print(profile.table())
+
+    or pass it to a single solve with Resolve.solve(specs, profile=profile).
+
+    Each entry of profile.phases is a dictionary with the phase name, the
+    wall and CPU time in seconds, the number of clauses and variables added
+    and SAT calls made during the phase (None for phases that do not use
+    the clauses), and the objective value reached by the phase, if any.
+    """
+    def __init__(self):
+        self.phases = []
+        self.current = None
+        self.prev = None
+
+    def __enter__(self):
+        global _profiler
+        self.prev = _profiler
+        _profiler = self
+        return self
+
+    def __exit__(self, *args):
+        global _profiler
+        self.stop()
+        _profiler = self.prev
+
+    def start(self, name, C=None):
+        """Ends the current phase, if any, and starts a new one. C is the
+        Clauses object the phase works on, if it exists yet.
+        """
+        self.stop(C)
+        counts = (0, 0, 0) if C is None else (len(C.clauses), C.m, C.nsat)
+        self.current = (C, counts, time(), process_time())
+        self.phases.append({'phase': name, 'objective': None})
+
+    def stop(self, C=None):
+        """Ends the current phase. C is used for the counts if the phase
+        created its Clauses object.
+        """
+        if self.current is None:
+            return
+        C0, (nz, m, nsat), t0, c0 = self.current
+        C = C0 or C
+        rec = self.phases[-1]
+        rec['wall'] = time() - t0
+        rec['cpu'] = process_time() - c0
+        rec['clauses'] = None if C is None else len(C.clauses) - nz
+        rec['vars'] = None if C is None else C.m - m
+        rec['sat_calls'] = None if C is None else C.nsat - nsat
+        self.current = None
+
+    def objective(self, value):
+        self.phases[-1]['objective'] = value
+
+    def to_json(self, path=None):
+        """Returns the phases as a JSON string, or writes them to path."""
+        if path is None:
+            return json.dumps(self.phases, indent=2, sort_keys=True)
+        with open(path, 'w') as fo:
+            json.dump(self.phases, fo, indent=2, sort_keys=True)
+
+    def table(self):
+        """Returns the phases as a text table."""
+        def fmt(val):
+            return '-' if val is None else str(val)
+        lines = ['%-26s %9s %9s %8s %7s %5s %10s' % (
+            'phase', 'wall', 'cpu', 'clauses', 'vars', 'sat', 'objective')]
+        for rec in self.phases:
+            lines.append('%-26s %9.4f %9.4f %8s %7s %5s %10s' % (
+                rec['phase'], rec['wall'], rec['cpu'], fmt(rec['clauses']),
+                fmt(rec['vars']), fmt(rec['sat_calls']), fmt(rec['objective'])))
+        lines.append('%-26s %9.4f %9.4f' % (
+            'total', sum(rec['wall'] for rec in self.phases),
+            sum(rec['cpu'] for rec in self.phases)))
+        return '\n'.join(lines)
+
+
+# os.replace overwrites an existing file on every platform; Python 2 only
+# has os.rename, which fails on Windows if the destination exists
+_replace = getattr(os, 'replace', os.rename)
+
+
+class SolveCache(object):
+    """A cache of solve results for Resolve, kept in memory and, if path is
+    given, in a directory of JSON files that persists across processes.
+
+    Entries are keyed by Resolve.cache_key. Resolve re-verifies every entry
+    against its index before using it, so a stale or corrupt entry is
+    never trusted.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.memory = {}
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        res = self.memory.get(key)
+        if res is None and self.path:
+            try:
+                with open(os.path.join(self.path, key + '.json')) as fi:
+                    res = json.load(fi)
+            except (IOError, OSError, ValueError):
+                return None
+            self.memory[key] = res
+        return res
+
+    def put(self, key, value):
+        self.memory[key] = value
+        if self.path:
+            # Write to a temporary file first, so that readers in other
+            # processes never see a partial entry
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fo:
+                json.dump(value, fo)
+            try:
+                _replace(tmp, os.path.join(self.path, key + '.json'))
+            except OSError:
+                # Python 2 cannot rename onto an existing file on Windows;
+                # another process has just written this entry, so drop ours
+                os.unlink(tmp)
+
+    def discard(self, key):
+        self.memory.pop(key, None)
+        if self.path:
+            try:
+                os.unlink(os.path.join(self.path, key + '.json'))
+            except OSError:
+                pass
+
+
+# The Resolve object used by SpecProbe instances in a probe pool worker
+_worker_resolve = None
+
+
+def _init_worker(r):
+    global _worker_resolve
+    _worker_resolve = r
+
+
+def _run_request(request):
+    method, args, kwargs = request
+    try:
+        return getattr(_worker_resolve, method)(*args, **kwargs)
+    except (NoPackagesFound, Unsatisfiable, SolveTimeout) as e:
+        return e
+
+
+class _SolveProgress(SolveProfile):
+    # Reports the start of each phase to callback, and calls interrupt,
+    # which can raise SolveCancelled, before it starts.
+    def __init__(self, callback, interrupt):
+        super(_SolveProgress, self).__init__()
+        self.callback = callback
+        self.interrupt = interrupt
+
+    def start(self, name, C=None):
+        self.interrupt()
+        super(_SolveProgress, self).start(name, C)
+        if self.callback is not None:
+            self.callback(name)
+
+
+def _run_async_request(request):
+    method, args, kwargs, rid, cancel, queue = request
+    r = _worker_resolve
+
+    def interrupt():
+        if cancel.is_set():
+            raise SolveCancelled()
+
+    def callback(phase):
+        queue.put((rid, phase))
+    r.interrupt = interrupt
+    try:
+        with _SolveProgress(callback if queue is not None else None, interrupt):
+            return getattr(r, method)(*args, **kwargs)
+    finally:
+        r.interrupt = None
+
+
+class SpecProbe(object):
+    """Tests whether a list of specs survives pruning, for use as the sat
+    function of minimal_unsatisfiable_subset.
+
+    Instances are picklable. The Resolve object is not pickled along with
+    the probe; an unpickled probe uses the one installed in the worker by
+    Resolve.start_probe_pool instead.
+    """
+    def __init__(self, r, removes, features):
+        self.r = r
+        self.removes = removes
+        self.features = features
+
+    def __reduce__(self):
+        return SpecProbe, (None, self.removes, self.features)
+
+    def __call__(self, specs):
+        r = _worker_resolve if self.r is None else self.r
+        return r.full_prune(specs, self.removes, [], self.features)[0]
+
+
 class Resolve(object):
-    def __init__(self, index):
+    def __init__(self, index, cache=None):
         self.index = index.copy()
         for fn, info in iteritems(index):
             for fstr in chain(info.get('features', '').split(),
@@ -256,8 +540,32 @@ class Resolve(object):
                 fn2 = fn + '[' + fstr + ']'
                 self.index[fn2] = info
         self.groups, self.trackers = build_groups(self.index)
+        # The feature sets of the packages are built once; packages with the
+        # same features share the same frozenset.
+        fsets = {}
+
+        def fset_(fstr):
+            res = fsets.get(fstr)
+            if res is None:
+                res = fsets[fstr] = frozenset(fstr.split())
+            return res
+        self.features_ = {fn: fset_(info.get('features', ''))
+                          for fn, info in iteritems(self.index)}
+        self.track_features_ = {fn: fset_(info.get('track_features', ''))
+                                for fn, info in iteritems(self.index)}
         self.find_matches_ = {}
         self.ms_depends_ = {}
+        self.valid_ = {}
+        self.version_order_ = {}
+        self.consistent_ = {}
+        self.probe_pool = None
+        self.portfolio = None
+        self.interrupt = None
+        self.lazy_depends = False
+        self.warm_start = False
+        self.unproven = []
+        self.cache = cache
+        self.fingerprint_ = None
 
     def default_filter(self, features=None, filter=None):
         if filter is None:
@@ -269,7 +577,17 @@ class Resolve(object):
             filter.update({fstr+'@': True for fstr in features})
         return filter
 
-    def valid(self, spec, filter):
+    def valid_memo(self, features):
+        """Returns the memo of package validity for the given set of active
+        features, shared by all the specs and requests that use them.
+        """
+        key = frozenset(features)
+        memo = self.valid_.get(key)
+        if memo is None:
+            memo = self.valid_[key] = self.default_filter(features)
+        return memo
+
+    def valid(self, spec, filter, memo=None):
         """Tests if a package, MatchSpec, or a list of both has satisfiable
         dependencies, assuming cyclic dependencies are always valid.
 
@@ -277,12 +595,18 @@ class Resolve(object):
             fn: a package key, a MatchSpec, or an iterable of these.
             filter: a dictionary of (fn,valid) pairs, used to consider a subset
                 of dependencies, and to eliminate repeated searches.
+            memo: (optional) a dictionary from valid_memo. The results that do
+                not rest on the assumption about a cyclic dependency are
+                stored in it instead of filter, for reuse by later searches.
 
         Returns:
             True if the full set of dependencies can be satisfied; False otherwise.
             If filter is supplied and update is True, it will be updated with the
             search results.
         """
+        if memo is not None:
+            return self.valid_memo_(spec, filter, memo)[0]
+
         def v_(spec):
             return v_ms_(spec) if isinstance(spec, MatchSpec) else v_fn_(spec)
 
@@ -298,6 +622,45 @@ class Resolve(object):
 
         return v_(spec)
 
+    def valid_memo_(self, spec, filter, memo):
+        # Same search as valid, but each result also says whether it is
+        # independent of where the search started: a result that reads the
+        # provisional value of a package still being searched is not, and
+        # is kept in filter rather than memo.
+        def v_ms_(ms):
+            if ms.optional:
+                return True, True
+            clean = True
+            for fn in self.find_matches(ms):
+                val, c = v_fn_(fn)
+                clean = clean and c
+                if val:
+                    return True, clean
+            return False, clean
+
+        def v_fn_(fn):
+            val = memo.get(fn)
+            if val is not None:
+                return val, True
+            val = filter.get(fn)
+            if val is not None:
+                return val, False
+            filter[fn] = True
+            val = clean = True
+            for ms in self.ms_depends(fn):
+                val, c = v_ms_(ms)
+                clean = clean and c
+                if not val:
+                    break
+            if clean:
+                del filter[fn]
+                memo[fn] = val
+            else:
+                filter[fn] = val
+            return val, clean
+
+        return v_ms_(spec) if isinstance(spec, MatchSpec) else v_fn_(spec)
+
     def touch(self, spec, touched, filter):
         """Determines a conservative set of packages to be considered given a
            package, or a spec, or a list thereof. Cyclic dependencies are not
@@ -330,7 +693,7 @@ class Resolve(object):
 
         return t_ms_(spec) if isinstance(spec, MatchSpec) else t_fn_(spec)
 
-    def invalid_chains(self, spec, filter):
+    def invalid_chains(self, spec, filter, memo=None):
         """Constructs a set of 'dependency chains' for invalid specs.
 
         A dependency chain is a tuple of MatchSpec objects, starting with
@@ -343,19 +706,30 @@ class Resolve(object):
             spec: a package key or MatchSpec
             filter: a dictionary of (fn,valid) pairs to be used when
                 testing for package validity.
+            memo: (optional) a validity memo, as passed to valid.
 
         Returns:
             A list of tuples, or an empty list if the MatchSpec is valid.
         """
+        # The chains below each spec are built once; the placeholder stops
+        # the recursion around a cycle of invalid packages.
+        done = {}
+
         def chains_(spec, top=None):
-            if spec.name == top or self.valid(spec, filter):
+            key = (spec, isinstance(spec, MatchSpec) and spec.optional)
+            res = done.get(key)
+            if res is not None:
+                return res
+            done[key] = []
+            if spec.name == top or self.valid(spec, filter, memo):
                 return []
             notfound = set()
             specs = self.find_matches(spec) if isinstance(spec, MatchSpec) else [spec]
             for fn in specs:
                 for m2 in self.ms_depends(fn):
                     notfound.update(chains_(m2))
-            return [(spec,) + x for x in notfound] if notfound else [(spec,)]
+            res = done[key] = [(spec,) + x for x in notfound] if notfound else [(spec,)]
+            return res
         return chains_(spec)
 
     def verify_specs(self, specs):
@@ -385,23 +759,53 @@ class Resolve(object):
                 spec2.append(ms)
             elif any(self.find_matches(ms)):
                 opts.append(ms)
+        memo = self.valid_memo(feats)
         for ms in spec2:
-            filter = self.default_filter(feats)
-            if not self.valid(ms, filter):
-                bad_deps.extend(self.invalid_chains(ms, filter))
+            filter = {}
+            if not self.valid(ms, filter, memo):
+                bad_deps.extend(self.invalid_chains(ms, filter, memo))
         if bad_deps:
             raise NoPackagesFound(bad_deps)
         return spec2, rems, opts, feats
 
-    def get_dists(self, specs):
-        log.debug('Retrieving packages for: %s' % specs)
+    def full_prune(self, specs, removes, optional, features):
+        """Prunes the index down to the packages that may participate in a
+        solution for the given specs.
 
-        specs, removes, optional, features = self.verify_specs(specs)
+        Args:
+            specs: a list of mandatory MatchSpecs, as returned by verify_specs.
+            removes: a list of MatchSpecs for packages that must be removed.
+            optional: a list of optional MatchSpecs.
+            features: a set of features to be activated.
+
+        Returns:
+            A tuple (ok, touched, snames, unsat). ok is False if a conflict
+            was detected, in which case unsat holds the dependency chains
+            that could not be satisfied. touched is a dictionary of (fn,valid)
+            pairs, and snames is the set of package names that every solution
+            must include.
+        """
         filter = {}
         touched = {}
         snames = set()
-        nspecs = set()
         unsat = []
+        # Reverse dependencies of the groups examined so far: the names of
+        # the groups with a package that depends on a given name. Feature
+        # dependencies are listed under their '@'-prefixed names.
+        rdeps = defaultdict(set)
+        registered = set()
+        applied = defaultdict(set)
+        # Groups with a dependency that lost packages since they were last
+        # examined; no other group can be pruned any further.
+        pending = set()
+        pruned = []
+
+        def prune_(fn):
+            filter[fn] = False
+            pruned.append(fn)
+            pending.update(rdeps.get(self.index[fn]['name'], ()))
+            for feat in self.track_features_[fn]:
+                pending.update(rdeps.get('@' + feat, ()))
 
         def filter_group(matches, chains=None):
             # If we are here, then this dependency is mandatory,
@@ -411,7 +815,19 @@ class Resolve(object):
             match1 = next(ms for ms in matches)
             name = match1.name
             first = name not in snames
+            # Nothing changes if these patterns were applied to the group
+            # before, and its dependencies have lost no packages since
+            key = frozenset(matches)
+            if not first and name not in pending and key in applied[name]:
+                return False
+            applied[name].add(key)
             group = self.groups.get(name, [])
+            if name not in registered:
+                registered.add(name)
+                for fn in group:
+                    for ms in self.ms_depends(fn):
+                        rdeps[ms.name].add(name)
+            pending.discard(name)
 
             # Prune packages that don't match any of the patterns
             # or which have unsatisfiable dependencies
@@ -423,8 +839,8 @@ class Resolve(object):
                     sat = self.match_any(matches, fn)
                     sat = sat and all(any(filter.get(f2, True) for f2 in self.find_matches(ms))
                                       for ms in self.ms_depends(fn))
-                    filter[fn] = sat
                     if not sat:
+                        prune_(fn)
                         bad_deps.append(fn)
 
             # Build dependency chains if we detect unsatisfiability
@@ -455,8 +871,6 @@ class Resolve(object):
             # not have a particular dependency, it must be ignored in this pass.
             if first:
                 snames.add(name)
-                if match1 not in specs:
-                    nspecs.add(MatchSpec(name))
             cdeps = defaultdict(list)
             for fn in group:
                 if filter[fn]:
@@ -473,63 +887,300 @@ class Resolve(object):
 
             return reduced
 
-        # Iterate in the filtering process until no more progress is made
-        def full_prune(specs, removes, optional, features):
+        def children_(fn):
+            for ms in self.ms_depends(fn):
+                if ms.name[0] != '@':
+                    for f2 in self.find_matches(ms):
+                        yield f2
+
+        # The packages touched by the specs, and their features, are
+        # maintained incrementally once they are first computed.
+        roots = set()
+        parents = defaultdict(set)
+        nfeats = defaultdict(int)
+        featured = defaultdict(set)
+        fpruned = []
+
+        def touch_all_():
+            for fstr in features:
+                touched[fstr+'@'] = True
+            for spec in chain(specs, optional):
+                self.touch(spec, touched, filter)
+                roots.update(self.find_matches(spec))
+            for fn, val in iteritems(touched):
+                if val:
+                    for feat in self.track_features_[fn]:
+                        nfeats[feat] += 1
+                    for feat in self.features_[fn]:
+                        featured[feat].add(fn)
+
+        def untouch_(removed):
+            # Unmark the removed packages and everything below them, then
+            # remark the part of that region still reachable from elsewhere
+            if not parents:
+                for fn, val in iteritems(touched):
+                    if val:
+                        for f2 in children_(fn):
+                            parents[f2].add(fn)
+            lost = set(removed)
+            stack = list(removed)
+            for fn in removed:
+                touched[fn] = False
+            while stack:
+                for f2 in children_(stack.pop()):
+                    if touched.get(f2):
+                        touched[f2] = False
+                        lost.add(f2)
+                        stack.append(f2)
+            stack = [fn for fn in lost if filter.get(fn, True) and
+                     (fn in roots or any(touched.get(f2) for f2 in parents[fn]))]
+            while stack:
+                fn = stack.pop()
+                if not touched[fn]:
+                    touched[fn] = True
+                    lost.remove(fn)
+                    stack.extend(f2 for f2 in children_(fn) if f2 in lost and filter[f2])
+            for fn in lost:
+                for feat in self.track_features_[fn]:
+                    nfeats[feat] -= 1
+                    if not nfeats[feat]:
+                        del nfeats[feat]
+                for feat in self.features_[fn]:
+                    featured[feat].discard(fn)
+
+        # Iterate in the filtering process until no more progress is made.
+        # Each pass visits only the groups that can still change: the pending
+        # ones, and the emptied ones, which add their conflicts to unsat.
+        def full_prune_():
             self.default_filter(features, filter)
             for ms in removes:
                 for fn in self.find_matches(ms):
                     filter[fn] = False
             feats = set(self.trackers.keys())
-            snames.clear()
-            specs = slist = list(specs)
+            slist = list(specs)
             onames = set(s.name for s in specs)
             for iter in range(10):
                 first = True
-                while sum(filter_group([s]) for s in slist):
+                while sum(filter_group([s]) for s in slist
+                          if not iter and first or s.name in pending or s.name not in snames):
                     slist = specs + [MatchSpec(n) for n in snames - onames]
                     first = False
                 if unsat:
                     return False
                 if first and iter:
                     return True
-                touched.clear()
-                for fstr in features:
-                    touched[fstr+'@'] = True
-                for spec in chain(specs, optional):
-                    self.touch(spec, touched, filter)
-                nfeats = set()
-                for fn, val in iteritems(touched):
-                    if val:
-                        nfeats.update(self.track_features(fn))
+                if iter == 0:
+                    touch_all_()
+                else:
+                    untouch_(fpruned + [fn for fn in pruned[npruned:] if touched.get(fn)])
+                    del fpruned[:]
                 if len(nfeats) >= len(feats):
                     return True
-                pruned = False
-                feats &= nfeats
-                for fn, val in iteritems(touched):
-                    if val and self.features(fn) - feats:
-                        touched[fn] = filter[fn] = False
-                        filter[fn] = False
-                        pruned = True
-                if not pruned:
+                feats.intersection_update(nfeats)
+                for feat in list(featured):
+                    if feat not in feats:
+                        for fn in featured.pop(feat):
+                            if touched[fn]:
+                                touched[fn] = False
+                                fpruned.append(fn)
+                                prune_(fn)
+                if not fpruned:
                     return True
+                if iter == 0:
+                    # Validity tests made while touching may have found
+                    # more packages with unsatisfiable dependencies
+                    for fn, val in iteritems(filter):
+                        if not val and fn in self.index:
+                            prune_(fn)
+                npruned = len(pruned)
+
+        specs = list(specs)
+        return full_prune_(), touched, snames, unsat
+
+    def start_probe_pool(self):
+        """Starts a pool of two processes on which get_dists runs the probes
+        of its conflict diagnosis. Each worker receives a copy of this
+        object once, when it is started. The pool is shut down by
+        stop_probe_pool.
+
+        Only the two halves of each bisection step are probed at once, so
+        the diagnosis is at most twice as fast as the serial one, and it
+        may make a few more probes; it does not scale with more cores.
+        """
+        import multiprocessing
+        self.stop_probe_pool()
+        self.probe_pool = multiprocessing.Pool(2, _init_worker, (self,))
+        return self.probe_pool
+
+    def stop_probe_pool(self):
+        if self.probe_pool is not None:
+            self.probe_pool.terminate()
+            self.probe_pool.join()
+            self.probe_pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['probe_pool'] = None
+        return state
+
+    def get_dists(self, specs):
+        log.debug('Retrieving packages for: %s' % specs)
+
+        _profile('verify_specs')
+        specs, removes, optional, features = self.verify_specs(specs)
+        _profile('prune')
+        ok, touched, snames, unsat = self.full_prune(specs, removes, optional, features)
 
         #
         # In the case of a conflict, look for the minimum satisfiable subset
         #
 
-        if not full_prune(specs, removes, optional, features):
-            def minsat_prune(specs):
-                return full_prune(specs, removes, [], features)
-
+        if not ok:
+            _profile('conflict diagnosis')
             save_unsat = set(s for s in unsat if s[0] in specs)
             stderrlog.info('...')
-            hint = minimal_unsatisfiable_subset(specs, sat=minsat_prune, log=False)
+            hint = minimal_unsatisfiable_subset(specs, sat=SpecProbe(self, removes, features),
+                                                log=False, pool=self.probe_pool)
             save_unsat.update((ms,) for ms in hint)
             raise Unsatisfiable(save_unsat)
 
         dists = {fn: self.index[fn] for fn, val in iteritems(touched) if val}
         return dists, list(map(MatchSpec, snames - {ms.name for ms in specs}))
 
+    def merge_builds(self, dists, specs):
+        """Merges the builds in dists that the solver cannot tell apart:
+        those with the same name, version, dependencies and features, which
+        match the same specs, among the given ones and the dependencies of
+        the packages in dists. Each set of such builds is replaced by the
+        one with the highest build number, which is at least as good as
+        the others under every objective of the solve. The builds of a
+        package named by a spec with a target are never merged, as the
+        version metrics then prefer the smallest change from the target
+        over the highest build.
+
+        Returns the reduced dists, and a dictionary that maps each build
+        that was kept in place of others to the list of those others.
+        """
+        # The specs that can tell builds of one version apart
+        mss = {}
+        tnames = set()
+        for ms in chain(specs, (ms for fn in dists for ms in self.ms_depends(fn))):
+            if ms.target:
+                tnames.add(ms.name)
+            if ms.strictness > 1:
+                mss.setdefault(ms.name, set()).add(ms)
+        classes = {}
+        for fn, rec in iteritems(dists):
+            name, version, build = rec['name'], rec['version'], rec['build']
+            if name in tnames:
+                continue
+            key = (name, version,
+                   frozenset((ms.spec, ms.optional) for ms in self.ms_depends(fn)),
+                   self.features_[fn], self.track_features_[fn],
+                   frozenset(ms for ms in mss.get(name, ()) if ms.match_fast(version, build)))
+            classes.setdefault(key, []).append(fn)
+        merged = {}
+        for group in itervalues(classes):
+            if len(group) > 1:
+                best = max(group, key=lambda fn: (self.version_key(fn), fn))
+                merged[best] = [fn for fn in group if fn != best]
+        if not merged:
+            return dists, merged
+        log.debug('Merged %d equivalent builds' % sum(map(len, itervalues(merged))))
+        drop = set(chain.from_iterable(itervalues(merged)))
+        return {fn: rec for fn, rec in iteritems(dists) if fn not in drop}, merged
+
+    def estimate(self, specs, installed=None, max_group=50, top=10):
+        """Estimates the size of the solve for the given specs, running only
+        verify_specs, the pruning and merge_builds. If installed is given,
+        the installed packages are added as targets, as install does with
+        update_deps=True (but without checking the consistency of the
+        environment).
+
+        Returns a dictionary with the number of candidate packages and of
+        package groups, the estimated number of clauses and variables of
+        the initial clause set, the largest groups and version ranges (the
+        top of each, as [name, size] and [name, versions, lowest, highest]
+        lists), and a list of warnings about patterns known to make solves
+        slow, such as groups of more than max_group candidates that no spec
+        pins to a version. If the pruning finds a conflict, 'ok' is False;
+        the conflict itself is only diagnosed by a full solve. Missing
+        packages raise NoPackagesFound, as in solve.
+        """
+        specs = list(map(MatchSpec, specs))
+        if installed:
+            snames = {s.name for s in specs}
+            for fn in installed:
+                if fn in self.index and self.package_name(fn) not in snames:
+                    specs.append(MatchSpec(self.package_name(fn), target=fn))
+        specs, removes, optional, features = self.verify_specs(specs)
+        ok, touched, snames, unsat = self.full_prune(specs, removes, optional, features)
+        dists = {fn: self.index[fn] for fn, val in iteritems(touched) if val}
+        dists, _ = self.merge_builds(dists, list(chain(specs, optional)))
+        groups, trackers = build_groups(dists)
+
+        # Count the clauses and variables that gen_clauses would create;
+        # the encoding of each group is measured once per group size.
+        def at_most_one(n):
+            res = sizes.get(n)
+            if res is None:
+                C = Clauses()
+                C.Require(C.AtMostOne, [C.new_var() for k in range(n)])
+                res = sizes[n] = (len(C.clauses), C.m - n)
+            return res
+        sizes = {}
+        nclauses = nvars = 0
+        for group in itervalues(groups):
+            nz, m = at_most_one(len(group))
+            nclauses += nz
+            nvars += len(group) + m
+        mvars = {}
+
+        def push_(ms, opt):
+            name = self.ms_to_v(ms)
+            if name not in mvars:
+                nlibs = sum(1 for fn in self.find_matches_group(ms, groups, trackers))
+                mvars[name] = (nlibs, opt)
+        for name in iterkeys(trackers):
+            push_(MatchSpec('@' + name), True)
+        for ms in chain(specs, optional):
+            push_(ms, ms.optional)
+        for fn in dists:
+            for ms in self.ms_depends(fn):
+                if not ms.optional:
+                    push_(ms, False)
+                    nclauses += 1
+        for nlibs, opt in itervalues(mvars):
+            if nlibs > 1:
+                nvars += 1
+                nclauses += 1 + (nlibs if opt else 0)
+
+        pinned = set(s.name for s in chain(specs, optional) if s.strictness > 1)
+        versions = []
+        warnings = []
+        for name, group in iteritems(groups):
+            vers = {self.index[fn]['version']: self.version_key(fn)[0] for fn in group}
+            vers = sorted(vers, key=vers.get)
+            versions.append([name, len(vers), vers[0], vers[-1]])
+            if len(group) > max_group and name not in pinned:
+                warnings.append('%s has %d candidates and no version pin' %
+                                (name, len(group)))
+        if not ok:
+            warnings.append('the pruning found a conflict')
+        versions.sort(key=lambda x: (-x[1], x[0]))
+        largest = sorted(([name, len(group)] for name, group in iteritems(groups)),
+                         key=lambda x: (-x[1], x[0]))
+        return {
+            'ok': ok,
+            'packages': len(dists),
+            'groups': len(groups),
+            'clauses': nclauses,
+            'vars': nvars,
+            'largest_groups': largest[:top],
+            'version_ranges': versions[:top],
+            'warnings': sorted(warnings),
+        }
+
     def match_any(self, mss, fn):
         rec = self.index[fn]
         n, v, b = rec['name'], rec['version'], rec['build']
@@ -571,7 +1222,7 @@ class Resolve(object):
                 deps = list(fdeps.values())
             else:
                 deps = [MatchSpec(d) for d in self.index[fn].get('depends', [])]
-            deps.extend(MatchSpec('@'+feat) for feat in self.features(fn))
+            deps.extend(MatchSpec('@'+feat) for feat in self.features_[fn])
             self.ms_depends_[fn] = deps
         return deps
 
@@ -580,10 +1231,10 @@ class Resolve(object):
         return (normalized_version(rec['version']), rec['build_number'])
 
     def features(self, fn):
-        return set(self.index[fn].get('features', '').split())
+        return set(self.features_[fn])
 
     def track_features(self, fn):
-        return set(self.index[fn].get('track_features', '').split())
+        return set(self.track_features_[fn])
 
     def package_triple(self, fn):
         if not fn.endswith('.tar.bz2'):
@@ -611,28 +1262,55 @@ class Resolve(object):
     def feat_to_v(feat):
         return '@s@@' + feat
 
-    def gen_clauses(self, groups, trackers, specs):
-        C = Clauses()
+    # Creates a variable that represents the proposition:
+    #     Does the package set include a package that matches MatchSpec "ms"?
+    def push_MatchSpec(self, C, ms, groups, trackers):
+        name = self.ms_to_v(ms)
+        m = C.from_name(name)
+        if m is None:
+            libs = [C.from_name(fn) for fn in self.find_matches_group(ms, groups, trackers)]
+            # If the MatchSpec is optional, then there may be cases where we want
+            # to assert that it is *not* True. This requires polarity=None.
+            m = C.Any(libs, polarity=None if ms.optional else True, name=name)
+        return m
+
+    # Create propositions that assert:
+    #     If package "fn" is installed, its dependencie must be satisfied
+    def push_depends(self, C, fn, groups, trackers):
+        m = C.from_name(fn)
+        for ms in self.ms_depends(fn):
+            if not ms.optional:
+                C.Require(C.Or, -m, self.push_MatchSpec(C, ms, groups, trackers))
 
-        # Creates a variable that represents the proposition:
-        #     Does the package set include a package that matches MatchSpec "ms"?
-        def push_MatchSpec(ms):
-            name = self.ms_to_v(ms)
-            m = C.from_name(name)
-            if m is None:
-                libs = [fn for fn in self.find_matches_group(ms, groups, trackers)]
-                # If the MatchSpec is optional, then there may be cases where we want
-                # to assert that it is *not* True. This requires polarity=None.
-                m = C.Any(libs, polarity=None if ms.optional else True, name=name)
-            return m
+    def missing_depends(self, C, solution, groups, trackers, done):
+        """Returns the packages installed by solution, other than those in
+        done, that have a dependency not satisfied by the solution.
+        """
+        installed = [q for q in (C.from_index(s) for s in solution if s > 0)
+                     if q and q[0] != '@' and q in self.index]
+        iset = set(installed)
+        return [fn for fn in installed if fn not in done and not
+                all(ms.optional or any(f2 in iset for f2 in
+                                       self.find_matches_group(ms, groups, trackers))
+                    for ms in self.ms_depends(fn))]
+
+    def gen_clauses(self, groups, trackers, specs, lazy=False):
+        """Generates the clauses for choosing packages from groups and
+        trackers, with a variable for each of the given specs. If lazy is
+        True, the dependency clauses are left out; push_depends adds them
+        for a package once it is needed.
+        """
+        C = Clauses()
+        C.phase = 'gen_clauses'
 
         # Creates a variable that represents the proposition:
         #     Does the package set include package "fn"?
+        # The packages get consecutive ids, which are used directly below;
+        # names are only needed to decode the solution.
         for group in itervalues(groups):
-            for fn in group:
-                C.new_var(fn)
+            ids = [C.new_var(fn) for fn in group]
             # Install no more than one version of each package
-            C.Require(C.AtMostOne, group)
+            C.Require(C.AtMostOne, ids)
 
         # Create a variable that represents the proposition:
         #     Is the feature "name" active in this package set?
@@ -641,20 +1319,17 @@ class Resolve(object):
         for name in iterkeys(trackers):
             ms = MatchSpec('@' + name)
             ms.optional = True
-            push_MatchSpec(ms)
+            self.push_MatchSpec(C, ms, groups, trackers)
 
         # Create a variable that represents the proposition:
         #     Is the MatchSpec "ms" satisfied by the current package set?
         for ms in specs:
-            push_MatchSpec(ms)
+            self.push_MatchSpec(C, ms, groups, trackers)
 
-        # Create propositions that assert:
-        #     If package "fn" is installed, its dependencie must be satisfied
-        for group in itervalues(groups):
-            for fn in group:
-                for ms in self.ms_depends(fn):
-                    if not ms.optional:
-                        C.Require(C.Or, C.Not(fn), push_MatchSpec(ms))
+        if not lazy:
+            for group in itervalues(groups):
+                for fn in group:
+                    self.push_depends(C, fn, groups, trackers)
         return C
 
     def generate_spec_constraints(self, C, specs):
@@ -667,7 +1342,7 @@ class Resolve(object):
         eq = {}
         total = 0
         for name, group in iteritems(groups):
-            nf = [len(self.features(fn)) for fn in group]
+            nf = [len(self.features_[fn]) for fn in group]
             maxf = max(nf)
             eq.update({fn: maxf-fc for fn, fc in zip(group, nf) if fc < maxf})
             total += maxf
@@ -682,7 +1357,21 @@ class Resolve(object):
             eq.update({fn: 1 for fn in groups.get(name, [])})
         return eq
 
-    def generate_version_metrics(self, C, groups, specs):
+    def version_order(self, name):
+        """Returns the (version_key, fn) pairs of all the packages named
+        name, newest first. The order is computed once per Resolve object.
+        """
+        res = self.version_order_.get(name)
+        if res is None:
+            res = self.version_order_[name] = sorted(
+                ((self.version_key(fn), fn) for fn in self.groups.get(name, [])),
+                reverse=True)
+        return res
+
+    def generate_version_metrics(self, C, groups, specs, merged=None):
+        # If merged is given, as returned by merge_builds, the builds merged
+        # into the packages of groups are ranked as well, so that the ranks
+        # are those of the groups before the merge.
         eqv = {}
         eqb = {}
         sdict = {}
@@ -690,19 +1379,21 @@ class Resolve(object):
             s = MatchSpec(s)  # needed for testing
             sdict.setdefault(s.name, []).append(s)
         for name, mss in iteritems(sdict):
-            pkgs = [(self.version_key(p), p) for p in groups.get(name, [])]
+            group = groups.get(name, [])
+            members = gset = set(group)
+            if merged:
+                members = gset.union(fn2 for fn in group for fn2 in merged.get(fn, ()))
+            pkgs = [p for p in self.version_order(name) if p[1] in members]
             # If the "target" field in the MatchSpec is supplied, that means we want
             # to minimize the changes to the currently installed package. We prefer
             # any upgrade over any downgrade, but beyond that we want minimal change.
             targets = [ms.target for ms in mss if ms.target]
             if targets:
                 tver = max(self.version_key(p) for p in targets)
-                v1 = [p for p in pkgs if p[1] in targets]
-                v2 = sorted((p for p in pkgs if p[0] >= tver and p[-1] not in targets))
-                v3 = sorted((p for p in pkgs if p[0] < tver), reverse=True)
+                v1 = [(self.version_key(p), p) for p in group if p in targets]
+                v2 = [p for p in reversed(pkgs) if p[0] >= tver and p[-1] not in targets]
+                v3 = [p for p in pkgs if p[0] < tver]
                 pkgs = v1 + v2 + v3
-            else:
-                pkgs = sorted(pkgs, reverse=True)
             pkey = ppkg = None
             for nkey, npkg in pkgs:
                 if pkey is None:
@@ -712,10 +1403,11 @@ class Resolve(object):
                     ib = 0
                 elif pkey[1] != nkey[1]:
                     ib += 1
-                if iv:
-                    eqv[npkg] = iv
-                if ib:
-                    eqb[npkg] = ib
+                if npkg in gset:
+                    if iv:
+                        eqv[npkg] = iv
+                    if ib:
+                        eqb[npkg] = ib
                 pkey, ppkg = nkey, npkg
         return eqv, eqb
 
@@ -771,6 +1463,45 @@ class Resolve(object):
         dotlog.debug('explicit(%r) finished' % specs)
         return res
 
+    def pinned(self, specs):
+        """Returns the solution for the given specs if their exact specs
+        (name, version and build) fix it on their own, or None.
+
+        Each exact spec with a single match pins that package. If the pinned
+        packages satisfy each other's dependencies, and every other spec is
+        satisfied by a pinned package of the same name, they are the only
+        solution, and no clauses need to be generated or solved.
+        """
+        pins = {}
+        rest = []
+        variants = False
+        for ms in specs:
+            if ms.name[-1] == '@' or ms.negate:
+                return None
+            if ms.strictness < 3 or ms.optional:
+                rest.append(ms)
+                continue
+            fns = self.find_matches(ms)
+            if len(fns) > 1:
+                # Feature variants (fn[feat]) can only be chosen if one of
+                # the pinned packages tracks the feature
+                fns = [fn for fn in fns if fn[-1] != ']']
+                variants = True
+            if len(fns) != 1 or pins.setdefault(ms.name, fns[0]) != fns[0]:
+                return None
+        if not pins:
+            return None
+        for ms in rest:
+            fn = pins.get(ms.name)
+            if fn is None or not (ms.optional or self.match(ms, fn)):
+                return None
+        if variants and any(self.track_features_[fn] for fn in itervalues(pins)):
+            return None
+        if not self.consistent(itervalues(pins)):
+            return None
+        dotlog.debug('pinned(%r) finished' % specs)
+        return sorted(fn.split('[')[0] for fn in itervalues(pins))
+
     def sum_matches(self, fn1, fn2):
         return sum(self.match(ms, fn2) for ms in self.ms_depends(fn1))
 
@@ -786,7 +1517,7 @@ class Resolve(object):
         candidates = {}
         for pkg in self.get_pkgs(MatchSpec(name + ' ' + version)):
             fn1 = pkg.fn
-            if self.features(fn1).intersection(features):
+            if self.features_[fn1].intersection(features):
                 continue
             key = sum(self.sum_matches(fn1, fn2) for fn2 in installed)
             candidates[key] = fn1
@@ -813,14 +1544,7 @@ class Resolve(object):
                 specs.append(MatchSpec(' '.join(self.package_triple(fn))))
         if xtra:
             log.debug('Packages missing from index: %s' % ', '.join(xtra))
-        groups, trackers = build_groups(dists)
-        C = self.gen_clauses(groups, trackers, specs)
-        constraints = self.generate_spec_constraints(C, specs)
-        try:
-            solution = C.sat(constraints)
-        except TypeError:
-            log.debug('Package set caused an unexpected error, assuming a conflict')
-            solution = None
+        solution = self.consistent(dists)
         limit = None
         if not solution or xtra:
             def get_(name, snames):
@@ -843,6 +1567,23 @@ class Resolve(object):
             log.debug('Packages to be preserved: %s' % ', '.join(xtra))
         return limit, xtra
 
+    def consistent(self, installed):
+        """Returns True if the given packages, all in the index, can be
+        installed together: there is one package per name, and each one has
+        its dependencies satisfied by the others.
+
+        The result is kept for each set of packages. It is not stored in
+        self.cache: checking is cheaper than a cache lookup.
+        """
+        pkgs = frozenset(installed)
+        res = self.consistent_.get(pkgs)
+        if res is None:
+            names = set(self.index[fn]['name'] for fn in pkgs)
+            res = self.consistent_[pkgs] = len(names) == len(pkgs) and all(
+                ms.optional or any(fn2 in pkgs for fn2 in self.find_matches(ms))
+                for fn in pkgs for ms in self.ms_depends(fn))
+        return res
+
     def restore_bad(self, pkgs, preserve):
         if preserve:
             sdict = {self.package_name(pkg): pkg for pkg in pkgs}
@@ -869,12 +1610,95 @@ class Resolve(object):
             specs.append(spec)
         return specs, preserve
 
-    def install(self, specs, installed=None, update_deps=True, returnall=False):
-        len0 = len(specs)
-        specs, preserve = self.install_specs(specs, installed or [], update_deps)
-        pkgs = self.solve(specs, len0=len0, returnall=returnall)
-        self.restore_bad(pkgs, preserve)
-        return pkgs
+    def fingerprint(self):
+        """Returns a stable hash of the index, for use in cache keys."""
+        if self.fingerprint_ is None:
+            data = json.dumps(self.index, sort_keys=True).encode('utf-8')
+            self.fingerprint_ = hashlib.sha256(data).hexdigest()
+        return self.fingerprint_
+
+    @staticmethod
+    def spec_key(spec):
+        if isinstance(spec, MatchSpec):
+            return repr(spec)
+        return ' '.join(spec.split())
+
+    def cache_key(self, *args):
+        data = json.dumps((self.fingerprint(),) + args).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def verify_solution(self, pkgs, specs, installed):
+        """Checks that a list of package filenames is a valid solution for
+        the given specs: one package per name, each either in the index or
+        among the installed packages, with all dependencies satisfied.
+        """
+        byname = {}
+        for fn in pkgs:
+            rec = self.index.get(fn)
+            if rec is None:
+                if fn not in installed:
+                    return False
+                name = self.package_name(fn)
+            else:
+                name = rec['name']
+            if name in byname:
+                return False
+            byname[name] = fn
+
+        def satisfied(ms):
+            fn = byname.get(ms.name)
+            return fn is not None and fn in self.index and self.match(ms, fn)
+
+        for fn in pkgs:
+            if fn in self.index:
+                for ms in self.ms_depends(fn):
+                    if ms.name[0] != '@' and not ms.optional and not satisfied(ms):
+                        return False
+        for ms in map(MatchSpec, specs):
+            if ms.negate:
+                if satisfied(MatchSpec(ms.spec)):
+                    return False
+            elif not ms.optional and not satisfied(ms):
+                return False
+        return True
+
+    def cached_solve(self, keyargs, specs, installed, returnall, solve):
+        """Returns the cached result for the request described by keyargs,
+        if it verifies; otherwise calls solve() and caches its result,
+        unless it was not proven optimal.
+        """
+        if self.cache is None:
+            return solve()
+        key = self.cache_key(*keyargs)
+        res = self.cache.get(key)
+        if res is not None:
+            sols = res if returnall else [res]
+            if (isinstance(res, list) and
+                    all(isinstance(sol, list) and
+                        self.verify_solution(sol, specs, installed) for sol in sols)):
+                log.debug('Using cached solution')
+                self.unproven = []
+                return Solution([list(sol) for sol in res] if returnall else res)
+            log.debug('Discarding invalid cache entry %s' % key)
+            self.cache.discard(key)
+        res = solve()
+        if isinstance(res, list) and not getattr(res, 'unproven', None):
+            self.cache.put(key, [list(sol) for sol in res] if returnall else list(res))
+        return res
+
+    def install(self, specs, installed=None, update_deps=True, returnall=False,
+                time_budget=None):
+        def solve():
+            specs2, preserve = self.install_specs(specs, installed, update_deps)
+            pkgs = self.solve(specs2, len0=len(specs), returnall=returnall,
+                              time_budget=time_budget,
+                              hint=installed if self.warm_start else None)
+            self.restore_bad(pkgs, preserve)
+            return pkgs
+        installed = list(installed or [])
+        keyargs = ('install', sorted(map(self.spec_key, specs)), sorted(installed),
+                   update_deps, returnall)
+        return self.cached_solve(keyargs, specs, installed, returnall, solve)
 
     def remove_specs(self, specs, installed):
         specs = [MatchSpec(s, optional=True, negate=True) for s in specs]
@@ -891,126 +1715,578 @@ class Resolve(object):
                 preserve.append(pkg)
         return specs, preserve
 
-    def remove(self, specs, installed):
-        specs, preserve = self.remove_specs(specs, installed)
-        pkgs = self.solve(specs)
-        self.restore_bad(pkgs, preserve)
-        return pkgs
-
-    def solve(self, specs, len0=None, returnall=False):
+    def remove(self, specs, installed, time_budget=None):
+        def solve():
+            specs2, preserve = self.remove_specs(specs, installed)
+            pkgs = self.solve(specs2, time_budget=time_budget)
+            self.restore_bad(pkgs, preserve)
+            return pkgs
+        keyargs = ('remove', sorted(map(self.spec_key, specs)), sorted(installed))
+        rspecs = [MatchSpec(s, optional=True, negate=True) for s in specs]
+        return self.cached_solve(keyargs, rspecs, installed, False, solve)
+
+    def solve(self, specs, len0=None, returnall=False, time_budget=None, profile=None,
+              hint=None):
+        """Finds the optimal package set for the given specs.
+
+        If time_budget is given, the solve gives up after roughly that many
+        seconds, which are shared among the optimization passes. Each pass
+        that runs out of time keeps the best solution found so far, and
+        its name is added to the unproven attribute of the returned
+        Solution, which lists the objectives that were not proven optimal.
+        (self.unproven is the same list for the last solve, but it is not
+        safe to rely on if other threads solve with this object.) If not
+        even a feasible solution is found in time, SolveTimeout is raised.
+
+        If profile is given, a SolveProfile, the phases of the solve are
+        recorded in it. If hint is given, a list of package filenames close
+        to the expected solution, it is used to warm-start the
+        minimizations; the result is optimal either way. Set
+        self.warm_start to have install pass the installed packages.
+        """
+        if profile is not None:
+            with profile:
+                return self.solve(specs, len0, returnall, time_budget, hint=hint)
+        self.unproven = []
+        deadline = None if time_budget is None else time() + time_budget
+        C = None
         try:
             stdoutlog.info("Solving package specifications: ")
             dotlog.debug("Solving for %s" % (specs,))
 
-            # Find the compliant packages
+            # Fully pinned requests need no SAT solve
             specs = list(map(MatchSpec, specs))
+            pkgs = self.pinned(specs)
+            if pkgs is not None:
+                return Solution([pkgs] if returnall else pkgs)
+
+            # Find the compliant packages
             if len0 is None:
                 len0 = len(specs)
             dists, new_specs = self.get_dists(specs)
             if not dists:
-                return False if dists is None else ([[]] if returnall else [])
+                return False if dists is None else Solution([[]] if returnall else [])
 
             # Check if satisfiable
             dotlog.debug('Checking satisfiability')
+            _profile('gen_clauses')
+            dists, merged = self.merge_builds(dists, specs)
             groups, trackers = build_groups(dists)
-            C = self.gen_clauses(groups, trackers, specs)
-            constraints = self.generate_spec_constraints(C, specs)
-            solution = C.sat(constraints, True)
-            if not solution:
-                # Find the largest set of specs that are satisfiable, and return
-                # the list of specs that are not in that set.
-                solution = [C.Not(q) for q in range(1, C.m+1)]
-                spec2 = [s for s in specs if not s.optional]
-                eq_removal_count = self.generate_removal_count(C, spec2)
-                solution, obj1 = C.minimize(eq_removal_count, solution)
-                specsol = [(s,) for s in spec2 if C.from_name(self.ms_to_v(s)) not in solution]
-                raise Unsatisfiable(specsol, False)
-
-            speco = []  # optional packages
-            specr = []  # requested packages
-            speca = []  # all other packages
-            specm = set(groups)  # missing from specs
-            for k, s in enumerate(chain(specs, new_specs)):
-                if s.name in specm:
-                    specm.remove(s.name)
-                if not s.optional:
-                    (specr if k < len0 else speca).append(s)
-                elif any(self.find_matches_group(s, groups, trackers)):
-                    speco.append(s)
-                    speca.append(s)
-            speca.extend(MatchSpec(s) for s in specm)
-
-            # Removed packages: minimize count
-            eq_optional_c = self.generate_removal_count(C, speco)
-            solution, obj7 = C.minimize(eq_optional_c, solution)
-            dotlog.debug('Package removal metric: %d' % obj7)
-
-            # Requested packages: maximize versions, then builds
-            eq_req_v, eq_req_b = self.generate_version_metrics(C, groups, specr)
-            solution, obj3 = C.minimize(eq_req_v, solution)
-            solution, obj4 = C.minimize(eq_req_b, solution)
-            dotlog.debug('Initial package version/build metrics: %d/%d' % (obj3, obj4))
-
-            # Track features: minimize feature count
-            eq_feature_count = self.generate_feature_count(C, trackers)
-            solution, obj1 = C.minimize(eq_feature_count, solution)
-            dotlog.debug('Track feature count: %d' % obj1)
-
-            # Featured packages: maximize featured package count
-            eq_feature_metric, ftotal = self.generate_feature_metric(C, groups)
-            solution, obj2 = C.minimize(eq_feature_metric, solution)
-            obj2 = ftotal - obj2
-            dotlog.debug('Package feature count: %d' % obj2)
-
-            # Remaining packages: maximize versions, then builds, then count
-            eq_v, eq_b = self.generate_version_metrics(C, groups, speca)
-            solution, obj5 = C.minimize(eq_v, solution)
-            solution, obj6 = C.minimize(eq_b, solution)
-            dotlog.debug('Additional package version/build metrics: %d/%d' % (obj5, obj6))
-
-            # Prune unnecessary packages
-            eq_c = self.generate_package_count(C, groups, specm)
-            solution, obj7 = C.minimize(eq_c, solution, trymax=True)
-            dotlog.debug('Weak dependency count: %d' % obj7)
-
-            def clean(sol):
-                return [q for q in (C.from_index(s) for s in sol)
-                        if q and q[0] != '!' and '@' not in q]
-            dotlog.debug('Looking for alternate solutions')
-            nsol = 1
-            psolutions = []
-            psolution = clean(solution)
-            psolutions.append(psolution)
-            while True:
-                nclause = tuple(C.Not(C.from_name(q)) for q in psolution)
-                solution = C.sat((nclause,), True)
-                if solution is None:
-                    break
-                nsol += 1
-                if nsol > 10:
-                    dotlog.debug('Too many solutions; terminating')
-                    break
-                psolution = clean(solution)
-                psolutions.append(psolution)
-
-            if nsol > 1:
-                psols2 = list(map(set, psolutions))
-                common = set.intersection(*psols2)
-                diffs = [sorted(set(sol) - common) for sol in psols2]
-                stdoutlog.info(
-                    '\nWarning: %s possible package resolutions '
-                    '(only showing differing packages):%s%s' %
-                    ('>10' if nsol > 10 else nsol,
-                     dashlist(', '.join(diff) for diff in diffs),
-                     '\n  ... and others' if nsol > 10 else ''))
-
-            def stripfeat(sol):
-                return sol.split('[')[0]
-            stdoutlog.info('\n')
-            if returnall:
-                return [sorted(map(stripfeat, psol)) for psol in psolutions]
-            else:
-                return sorted(map(stripfeat, psolutions[0]))
+            C = self.gen_clauses(groups, trackers, specs, lazy=self.lazy_depends)
+            self.configure_clauses(C)
+            return self.solve_clauses(C, specs, new_specs, groups, trackers,
+                                      len0, returnall, time_budget, deadline, hint,
+                                      merged)
         except:
             stdoutlog.info('\n')
             raise
+        finally:
+            _profile_stop(C)
+
+    def solve_many(self, specs_list, returnall=False, ratio=1.25):
+        """Solves several independent sets of specs in one batch.
+
+        Repeated requests are solved once, and fully pinned ones need no
+        SAT solve. The others are pruned one by one, sharing the memos of
+        this object, and grouped: a request joins a group if the union of
+        the pruned package sets of the group stays within ratio times the
+        size of each of them. The clauses of each group are generated
+        once, for that union. Each request is then solved inside a
+        checkpoint of those clauses, with the variables of its own specs,
+        and with the packages outside its own pruned set forbidden, so that
+        it sees the same problem as it would in solve().
+        Returns a list with the result of each request, or the exception
+        (NoPackagesFound or Unsatisfiable) that solve() would have raised.
+        """
+        results = [None] * len(specs_list)
+        first = {}
+        repeats = []
+        groups_ = []
+        for k, specs in enumerate(specs_list):
+            dotlog.debug("Solving for %s" % (specs,))
+            specs = list(map(MatchSpec, specs))
+            key = tuple(map(self.spec_key, specs))
+            if key in first:
+                repeats.append((k, first[key]))
+                continue
+            first[key] = k
+            pkgs = self.pinned(specs)
+            if pkgs is not None:
+                results[k] = Solution([pkgs] if returnall else pkgs)
+                continue
+            try:
+                dists, new_specs = self.get_dists(specs)
+            except (NoPackagesFound, Unsatisfiable) as e:
+                results[k] = e
+                continue
+            if not dists:
+                results[k] = Solution([[]] if returnall else [])
+                continue
+            dists, merged = self.merge_builds(dists, specs)
+            req = (k, specs, dists, new_specs, merged)
+            for group in groups_:
+                alldists, smallest, reqs = group
+                nunion = len(alldists) + sum(fn not in alldists for fn in dists)
+                if nunion <= ratio * min(smallest, len(dists)):
+                    alldists.update(dists)
+                    group[1] = min(smallest, len(dists))
+                    reqs.append(req)
+                    break
+            else:
+                groups_.append([dict(dists), len(dists), [req]])
+
+        for alldists, _, reqs in groups_:
+            # A request alone gets exactly the clauses that solve() generates
+            single = len(reqs) == 1
+            _profile('gen_clauses')
+            groups, trackers = build_groups(alldists)
+            C = self.gen_clauses(groups, trackers, reqs[0][1] if single else [],
+                                 lazy=self.lazy_depends)
+            self.configure_clauses(C)
+            _profile_stop(C)
+            for k, specs, dists, new_specs, merged in reqs:
+                stdoutlog.info("Solving package specifications: ")
+                C.push()
+                try:
+                    groups, trackers = build_groups(dists)
+                    if not single:
+                        for ms in specs:
+                            self.push_MatchSpec(C, ms, groups, trackers)
+                        C.Prevent(C.Any, [C.from_name(fn) for fn in alldists
+                                          if fn not in dists])
+                    results[k] = self.solve_clauses(C, specs, new_specs, groups, trackers,
+                                                    len(specs), returnall, None, None,
+                                                    merged=merged)
+                except (NoPackagesFound, Unsatisfiable) as e:
+                    stdoutlog.info('\n')
+                    results[k] = e
+                finally:
+                    _profile_stop(C)
+                    C.pop()
+
+        for k, k0 in repeats:
+            res = results[k0]
+            if isinstance(res, Solution):
+                res = Solution([list(sol) for sol in res] if returnall else res,
+                               res.unproven)
+            results[k] = res
+        return results
+
+    def configure_clauses(self, C):
+        # Set self.portfolio to a logic.Portfolio to race several solver
+        # configurations on each SAT call and minimization.
+        C.portfolio = self.portfolio
+
+        # Set self.interrupt to a function to be called before each SAT
+        # call; it can raise SolveCancelled to stop the solve.
+        C.interrupt = self.interrupt
+
+        # Set CONDA_SAT_DUMP_DIR to save every SAT instance of this solve
+        # in DIMACS format, for replay with Clauses.from_dimacs.
+        dump_dir = os.getenv('CONDA_SAT_DUMP_DIR')
+        if dump_dir:
+            C.dimacs_dir = tempfile.mkdtemp(prefix='solve-', dir=dump_dir)
+            log.debug('Writing SAT instances to %s' % C.dimacs_dir)
+
+    def solve_clauses(self, C, specs, new_specs, groups, trackers, len0, returnall,
+                      time_budget, deadline, hint=None, merged=None):
+        """Runs the optimization passes of solve() on the clauses C, which
+        were generated for the packages in groups and trackers.
+        """
+        unproven = self.unproven = []
+
+        def set_phase(name, nleft):
+            # Note whether the last objective was proven optimal, then
+            # give the next pass its share of the remaining time budget
+            if C.timed_out:
+                unproven.append(C.phase)
+                C.timed_out = False
+            C.phase = name
+            _profile(name, C)
+            if deadline is not None:
+                now = time()
+                C.deadline = now + max(deadline - now, 0) / nleft
+
+        # Set self.lazy_depends to generate the dependency clauses of each
+        # package only once a solution installs it without its dependencies.
+        # Each such solution is discarded, and found again with the new
+        # clauses, so the results are those of the full clause set.
+        done = set()
+
+        def complete_(missing):
+            for fn in missing:
+                if fn not in done:
+                    done.add(fn)
+                    self.push_depends(C, fn, groups, trackers)
+
+        def lazily(func, *args, **kwargs):
+            if not self.lazy_depends:
+                return func(*args, **kwargs)
+            while True:
+                C.push()
+                res = func(*args, **kwargs)
+                sol = res[0] if isinstance(res, tuple) else res
+                missing = sol and self.missing_depends(C, sol, groups, trackers, done)
+                if not missing:
+                    C.pop(restore=False)
+                    return res
+                C.pop()
+                complete_(missing)
+
+        # If a hint is given, a list of package filenames (for install with
+        # self.warm_start set, the installed packages), the first model
+        # keeps as many of them as the specs allow. That model then serves
+        # as the incumbent of each minimization it improves on, whenever it
+        # is still feasible, so that the bisection starts from a tight
+        # upper bound.
+        def closure_(names):
+            seen = set()
+            names = list(names)
+            while names:
+                name = names.pop()
+                if name not in seen:
+                    seen.add(name)
+                    for fn in groups.get(name, ()):
+                        names.extend(ms.name for ms in self.ms_depends(fn))
+            return seen
+
+        def objval(objective, sol):
+            sol = set(sol)
+            return sum(c for k, c in iteritems(objective) if C.from_name(k) in sol)
+
+        def warm_(objective, solution):
+            # The hint model cannot be feasible any more if it is worse than
+            # the solution on one of the objectives minimized so far.
+            if warm and any(objval(eq, warm[0]) > objval(eq, solution) for eq in minimized):
+                del warm[:]
+            minimized.append(objective)
+            # Checking that the hint model is still feasible takes a SAT
+            # call, which only pays off if it saves more than one step of
+            # the bisection. A value of zero needs no help, since that is
+            # the first value the bisection tries.
+            value = objval(objective, warm[0]) if warm else 0
+            if not value or value.bit_length() + 1 >= objval(objective, solution).bit_length():
+                return solution
+            sol = lazily(C.sat, pins)
+            if not sol:
+                del warm[:]
+                return solution
+            warm[0] = sol
+            return sol if objval(objective, sol) < objval(objective, solution) else solution
+
+        set_phase('satisfiability', 1)
+        constraints = self.generate_spec_constraints(C, specs)
+        pins = [(fn,) for fn in hint or () if C.from_name(fn) is not None]
+        warm = []
+        minimized = []
+        if pins:
+            # If the hint as a whole conflicts with the specs, only keep the
+            # packages that the requested specs cannot depend on.
+            rnames = closure_(s.name for s in specs[:len0])
+            for cand in (pins, [p for p in pins if self.package_name(p[0]) not in rnames]):
+                if cand:
+                    warm = [lazily(C.sat, constraints + cand)]
+                    if warm[0]:
+                        C.Require(C.All, [c[0] for c in constraints])
+                        pins = cand
+                        break
+                    # A pinned attempt that ran out of time says nothing
+                    # about the specs themselves
+                    C.timed_out = False
+            if not warm[0]:
+                warm = []
+        solution = warm[0] if warm else lazily(C.sat, constraints, True)
+        if C.timed_out:
+            raise SolveTimeout(time_budget)
+        if not solution:
+            # Find the largest set of specs that are satisfiable, and return
+            # the list of specs that are not in that set.
+            solution = [C.Not(q) for q in range(1, C.m+1)]
+            spec2 = [s for s in specs if not s.optional]
+            set_phase('unsatisfiable specs', 1)
+            eq_removal_count = self.generate_removal_count(C, spec2)
+            solution, obj1 = lazily(C.minimize, eq_removal_count, solution)
+            _profile_objective(obj1)
+            specsol = [(s,) for s in spec2 if C.from_name(self.ms_to_v(s)) not in solution]
+            raise Unsatisfiable(specsol, False)
+
+        speco = []  # optional packages
+        specr = []  # requested packages
+        speca = []  # all other packages
+        specm = set(groups)  # missing from specs
+        for k, s in enumerate(chain(specs, new_specs)):
+            if s.name in specm:
+                specm.remove(s.name)
+            if not s.optional:
+                (specr if k < len0 else speca).append(s)
+            elif any(self.find_matches_group(s, groups, trackers)):
+                speco.append(s)
+                speca.append(s)
+        speca.extend(MatchSpec(s) for s in specm)
+
+        # Removed packages: minimize count
+        set_phase('removal count', 9)
+        eq_optional_c = self.generate_removal_count(C, speco)
+        solution, obj7 = lazily(C.minimize, eq_optional_c, warm_(eq_optional_c, solution))
+        _profile_objective(obj7)
+        dotlog.debug('Package removal metric: %d' % obj7)
+
+        # Requested packages: maximize versions, then builds
+        eq_req_v, eq_req_b = self.generate_version_metrics(C, groups, specr, merged)
+        set_phase('requested versions', 8)
+        solution, obj3 = lazily(C.minimize, eq_req_v, warm_(eq_req_v, solution))
+        _profile_objective(obj3)
+        set_phase('requested builds', 7)
+        solution, obj4 = lazily(C.minimize, eq_req_b, warm_(eq_req_b, solution))
+        _profile_objective(obj4)
+        dotlog.debug('Initial package version/build metrics: %d/%d' % (obj3, obj4))
+
+        # Track features: minimize feature count
+        set_phase('track feature count', 6)
+        eq_feature_count = self.generate_feature_count(C, trackers)
+        solution, obj1 = lazily(C.minimize, eq_feature_count, warm_(eq_feature_count, solution))
+        _profile_objective(obj1)
+        dotlog.debug('Track feature count: %d' % obj1)
+
+        # Featured packages: maximize featured package count
+        set_phase('package feature count', 5)
+        eq_feature_metric, ftotal = self.generate_feature_metric(C, groups)
+        solution, obj2 = lazily(C.minimize, eq_feature_metric, warm_(eq_feature_metric, solution))
+        obj2 = ftotal - obj2
+        _profile_objective(obj2)
+        dotlog.debug('Package feature count: %d' % obj2)
+
+        # Remaining packages: maximize versions, then builds, then count
+        eq_v, eq_b = self.generate_version_metrics(C, groups, speca, merged)
+        set_phase('additional versions', 4)
+        solution, obj5 = lazily(C.minimize, eq_v, warm_(eq_v, solution))
+        _profile_objective(obj5)
+        set_phase('additional builds', 3)
+        solution, obj6 = lazily(C.minimize, eq_b, warm_(eq_b, solution))
+        _profile_objective(obj6)
+        dotlog.debug('Additional package version/build metrics: %d/%d' % (obj5, obj6))
+
+        # Prune unnecessary packages
+        set_phase('weak dependency count', 2)
+        eq_c = self.generate_package_count(C, groups, specm)
+        solution, obj7 = lazily(C.minimize, eq_c, warm_(eq_c, solution), trymax=True)
+        _profile_objective(obj7)
+        dotlog.debug('Weak dependency count: %d' % obj7)
+
+        def clean(sol):
+            return [q for q in (C.from_index(s) for s in sol)
+                    if q and q[0] != '!' and '@' not in q]
+        dotlog.debug('Looking for alternate solutions')
+        set_phase('alternate solutions', 1)
+        # Enumerate the distinct package sets, starting with the optimum
+        # we already have; an 11th solution only tells us there are >10.
+        nsol = 1
+        psolutions = [clean(solution)]
+        pkgvars = set(C.from_name(fn) for group in itervalues(groups)
+                      for fn in group if '@' not in fn)
+        nclause = tuple(-k for k in solution if k in pkgvars)
+        while True:
+            alternates = []
+            missing = None
+            for sol in C.itersolve((nclause,), project=pkgvars, limit=10):
+                missing = self.lazy_depends and \
+                    self.missing_depends(C, sol, groups, trackers, done)
+                if missing:
+                    break
+                alternates.append(sol)
+            if not missing:
+                break
+            complete_(missing)
+        for solution in alternates:
+            nsol += 1
+            if nsol > 10:
+                dotlog.debug('Too many solutions; terminating')
+                break
+            psolutions.append(clean(solution))
+
+        if nsol > 1:
+            psols2 = list(map(set, psolutions))
+            common = set.intersection(*psols2)
+            diffs = [sorted(set(sol) - common) for sol in psols2]
+            stdoutlog.info(
+                '\nWarning: %s possible package resolutions '
+                '(only showing differing packages):%s%s' %
+                ('>10' if nsol > 10 else nsol,
+                 dashlist(', '.join(diff) for diff in diffs),
+                 '\n  ... and others' if nsol > 10 else ''))
+
+        if C.timed_out:
+            # The search for alternate solutions may have been cut short
+            unproven.append(C.phase)
+            C.timed_out = False
+        if unproven:
+            stdoutlog.info(
+                '\nWarning: the time budget ran out; the following '
+                'objectives were not proven optimal:%s' % dashlist(unproven))
+
+        def stripfeat(sol):
+            return sol.split('[')[0]
+        stdoutlog.info('\n')
+        if returnall:
+            res = [sorted(map(stripfeat, psol)) for psol in psolutions]
+        else:
+            res = sorted(map(stripfeat, psolutions[0]))
+        return Solution(res, unproven)
+
+
+class ParallelResolver(object):
+    """Runs independent solve, install and remove requests against one
+    Resolve object on a process pool.
+
+    Each worker receives a copy of the Resolve object once, when it is
+    started (by inheritance, where processes are forked); after that only
+    the specs of each request are sent to it. Results come back in the
+    order the requests were submitted. A request that fails with
+    NoPackagesFound, Unsatisfiable or SolveTimeout has the exception in
+    place of its result.
+    """
+    def __init__(self, r, processes=None):
+        import multiprocessing
+        self.r = r
+        self.pool = multiprocessing.Pool(processes, _init_worker, (r,))
+
+    def map(self, method, requests):
+        """Calls the given method of the Resolve object once for each
+        (args, kwargs) pair in requests, and returns the results in order.
+        """
+        requests = [(method, tuple(args), dict(kwargs)) for args, kwargs in requests]
+        return self.pool.map(_run_request, requests, chunksize=1)
+
+    def solve(self, specs_list, **kwargs):
+        return self.map('solve', [((specs,), kwargs) for specs in specs_list])
+
+    def install(self, specs_list, installed=None, **kwargs):
+        return self.map('install', [((specs, installed), kwargs) for specs in specs_list])
+
+    def remove(self, specs_list, installed, **kwargs):
+        return self.map('remove', [((specs, installed), kwargs) for specs in specs_list])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncResolver(object):
+    """Runs solve, install and remove requests against one Resolve object
+    on a process pool, for use from asyncio code:
+
+        resolver = AsyncResolver(r)
+        pkgs = await resolver.ainstall(specs, installed)
+
+    Each worker receives a copy of the Resolve object once, when it is
+    started, and keeps its caches across the requests it serves. The
+    methods return asyncio futures. Cancelling one stops its solve before
+    the next phase or SAT call, with SolveCancelled in the worker. If a
+    progress function is given, it is called in the event loop with the
+    name of each phase of the solve as it starts, and always before the
+    future is done.
+    """
+    def __init__(self, r, processes=None):
+        import multiprocessing
+        import threading
+        from concurrent.futures import ProcessPoolExecutor
+        self.r = r
+        self.manager = multiprocessing.Manager()
+        self.queue = self.manager.Queue()
+        self.executor = ProcessPoolExecutor(processes, initializer=_init_worker,
+                                            initargs=(r,))
+        self.requests = {}
+        self.nrequests = 0
+        self.thread = threading.Thread(target=self.dispatch_)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def dispatch_(self):
+        # Forwards the progress reports of the workers to the event loops.
+        # The end of each request comes through the same queue, after its
+        # last report, so its future is completed after the reports.
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            rid, phase = item
+            req = self.requests.get(rid) if phase else self.requests.pop(rid, None)
+            if req is None:
+                continue
+            cancel, loop, progress, fut, cfut = req
+            try:
+                if phase:
+                    loop.call_soon_threadsafe(progress, phase)
+                else:
+                    loop.call_soon_threadsafe(self.finish_, fut, cfut)
+            except RuntimeError:
+                # The event loop was closed
+                pass
+
+    @staticmethod
+    def finish_(fut, cfut):
+        if fut.done():
+            return
+        if cfut.cancelled():
+            fut.cancel()
+        elif cfut.exception() is not None:
+            fut.set_exception(cfut.exception())
+        else:
+            fut.set_result(cfut.result())
+
+    def submit(self, method, args=(), kwargs=None, progress=None, loop=None):
+        """Calls the given method of the Resolve object in a worker, and
+        returns an asyncio future for its result.
+        """
+        import asyncio
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.nrequests += 1
+        rid = self.nrequests
+        cancel = self.manager.Event()
+        request = (method, tuple(args), dict(kwargs or {}), rid, cancel,
+                   self.queue if progress else None)
+        fut = loop.create_future()
+        cfut = self.executor.submit(_run_async_request, request)
+        self.requests[rid] = (cancel, loop, progress, fut, cfut)
+
+        def cancelled(fut):
+            if fut.cancelled():
+                cfut.cancel()
+                cancel.set()
+        fut.add_done_callback(cancelled)
+        cfut.add_done_callback(lambda cfut: self.queue.put((rid, None)))
+        return fut
+
+    def asolve(self, specs, progress=None, loop=None, **kwargs):
+        return self.submit('solve', (specs,), kwargs, progress, loop)
+
+    def ainstall(self, specs, installed=None, progress=None, loop=None, **kwargs):
+        return self.submit('install', (specs, installed), kwargs, progress, loop)
+
+    def aremove(self, specs, installed, progress=None, loop=None, **kwargs):
+        return self.submit('remove', (specs, installed), kwargs, progress, loop)
+
+    def close(self):
+        if self.executor is not None:
+            for req in list(self.requests.values()):
+                req[0].set()
+            self.executor.shutdown()
+            self.queue.put(None)
+            self.thread.join()
+            self.manager.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
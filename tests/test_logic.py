@@ -267,3 +267,204 @@ def test_minimal_unsatisfiable_subset():
         res = minimal_unsatisfiable_subset(perm, sat)
         assert sorted(res) in [[[-1], [1]], [[-2], [2]]]
         assert not sat(res)
+
+def test_minimal_unsatisfiable_subset_quickxplain():
+    def sat(val):
+        return Clauses(max(abs(v) for v in chain(*val))).sat(val)
+
+    clauses = [[-10], [1], [5], [2, 3], [3, 4], [5, 2], [-7], [2], [3],
+        [-2, -3, 5], [7, 8, 9, 10], [-8], [-9]]
+    res = minimal_unsatisfiable_subset(clauses, sat, method='quickxplain')
+    assert sorted(res) == [[-10], [-9], [-8], [-7], [7, 8, 9, 10]]
+
+    clauses = [[1], [-1], [2], [-2], [3, 4], [4]]
+    for perm in permutations(clauses):
+        res = minimal_unsatisfiable_subset(perm, sat, method='quickxplain')
+        assert sorted(res) in [[[-1], [1]], [[-2], [2]]]
+        assert not sat(res)
+
+    assert raises(ValueError, lambda: minimal_unsatisfiable_subset(
+        clauses, sat, method='foo'))
+
+def test_minimal_unsatisfiable_subset_memo():
+    seen = []
+    def sat(val):
+        seen.append(frozenset(map(tuple, val)))
+        return Clauses(max(abs(v) for v in chain(*val))).sat(val)
+
+    clauses = [[-10], [1], [5], [2, 3], [3, 4], [5, 2], [-7], [2], [3],
+        [-2, -3, 5], [7, 8, 9, 10], [-8], [-9]]
+    for method in ('bisect', 'quickxplain'):
+        del seen[:]
+        stats = {}
+        minimal_unsatisfiable_subset(clauses, sat, method=method, stats=stats)
+        assert stats['probes'] == len(seen) == len(set(seen))
+
+def test_minimal_unsatisfiable_subset_pool():
+    class SerialPool(object):
+        def map(self, func, iterable):
+            return list(map(func, iterable))
+
+    def sat(val):
+        return Clauses(max(abs(v) for v in chain(*val))).sat(val)
+
+    clauses = [[1], [-1], [2], [-2], [3, 4], [4]]
+    for perm in permutations(clauses):
+        res1 = minimal_unsatisfiable_subset(perm, sat)
+        res2 = minimal_unsatisfiable_subset(perm, sat, pool=SerialPool())
+        assert res1 == res2
+
+def test_itersolve_project():
+    C = Clauses()
+    x1, x2, x3 = C.new_var('x1'), C.new_var('x2'), C.new_var('x3')
+    C.Require(C.Any, (x1, x2, x3))
+    assert len(list(C.itersolve())) == 7
+    sols = list(C.itersolve(project=['x1'], exact=True))
+    assert sorted(sol[0] for sol in sols) == [-1, 1]
+    sols = list(C.itersolve([(x1,)], project=[x2, x3], exact=True))
+    assert len(sols) == 4
+    assert len(list(C.itersolve(project=[x2, x3], limit=2, exact=True))) == 2
+    # By default, a solution is blocked by its true projected variables,
+    # so no later solution includes all of them
+    sols = [set(k for k in sol if k > 0 and k in (x2, x3))
+            for sol in C.itersolve([(x1,)], project=[x2, x3])]
+    assert all(not s1 <= s2 for k, s1 in enumerate(sols) for s2 in sols[k+1:])
+    assert len(list(C.itersolve([(x1,), (-x2,), (-x3,)], project=[x2, x3]))) == 1
+    assert len(list(C.itersolve(project=[]))) == 1
+    # A suspended iteration leaves the clause set untouched
+    nz = len(C.clauses)
+    it = C.itersolve([(x1,)], project=[x2, x3])
+    next(it)
+    next(it)
+    assert len(C.clauses) == nz and not C.stack
+    assert C.sat([(-x1,)]) is not None
+
+def test_dimacs():
+    import os
+    import tempfile
+    C = Clauses()
+    x1, x2 = C.new_var('x1'), C.new_var('x 2')
+    C.Require(C.ExactlyOne, (x1, x2, C.new_var()))
+    C.Or(x1, x2, name='x1|x2')
+    fd, path = tempfile.mkstemp(suffix='.cnf')
+    os.close(fd)
+    try:
+        C.to_dimacs(path, [('x1',)])
+        C2 = Clauses.from_dimacs(path)
+    finally:
+        os.unlink(path)
+    assert C2.m == C.m
+    assert C2.names == C.names and C2.indices == C.indices
+    assert C2.clauses == C.clauses + [(x1,)]
+    assert C2.sat(names=True) == C.sat([('x1',)], names=True)
+
+def test_minimize_deadline():
+    C = Clauses(10)
+    C.Require(C.ExactlyOne, range(1,6))
+    C.Require(C.ExactlyOne, range(6,11))
+    objective = [(k,k) for k in range(1,11)]
+    sol = C.sat()
+    C.deadline = 0
+    assert C.sat() is None and C.timed_out
+    sol2, sval = C.minimize(objective, sol)
+    assert sol2 == sol and C.timed_out
+    assert sval == evaluate_eq(objective, sol)
+    C.deadline = None
+    C.timed_out = False
+    assert all(evaluate_eq(objective, s) <= sval for s in C.itersolve())
+    assert C.minimize(objective, sol)[1] == 7
+
+def test_push_pop():
+    C = Clauses()
+    x1, x2 = C.new_var('x1'), C.new_var('x2')
+    C.Require(C.Or, x1, x2)
+    state = (list(C.clauses), C.m, dict(C.names), list(C.indices))
+    C.push()
+    C.Or(x1, x2, name='x3')
+    C.name_var(x1, 'x2')
+    C.push()
+    C.Require(C.And, 'x1', '!x1')
+    assert C.unsat
+    C.pop()
+    assert not C.unsat and C.names['x2'] == x1
+    C.pop()
+    assert (C.clauses, C.m, C.names, C.indices) == state
+    C.push()
+    x3 = C.new_var('x3')
+    C.pop(restore=False)
+    assert C.from_name('x3') == x3 and not C.stack and not C.journal
+
+def test_names():
+    C = Clauses()
+    x1 = C.new_var('x1')
+    x2 = C.Not(x1, name='x2')
+    C.new_var()
+    assert C.names == {'x1': x1, 'x2': -x1}
+    assert C.from_name('!x1') == -x1 and C.from_name('!x2') == x1
+    assert C.from_index(x1) == 'x1' and C.from_index(-x1) == '!x1'
+    assert C.from_index(2) is None and C.from_index(10) is None
+    assert C.from_name('x3') is None and C.from_name('!x3') is None
+    assert raises(KeyError, lambda: C.varnum('!x3'))
+    C2 = Clauses()
+    C2.name_var(-C2.new_var(), 'y')
+    assert C2.from_index(1) == '!y' and C2.from_index(-1) == 'y'
+
+def test_minimize_linear():
+    C = Clauses(10)
+    C.Require(C.ExactlyOne, range(1,6))
+    C.Require(C.ExactlyOne, range(6,11))
+    objective = [(k,k) for k in range(1,11)]
+    sol = C.sat()
+    assert C.minimize(objective, sol, strategy='linear')[1] == 7
+
+def test_portfolio():
+    from libconda.logic import Portfolio
+    C = Clauses(10)
+    C.Require(C.ExactlyOne, range(1,6))
+    C.Require(C.ExactlyOne, range(6,11))
+    C.portfolio = Portfolio([{'seed': 0}, {'seed': 1, 'strategy': 'linear'}])
+    sol = C.sat()
+    assert sol is not None and C.sat([(1,), (2,)]) is None
+    objective = [(k,k) for k in range(1,11)]
+    sol2, sval = C.minimize(objective, sol)
+    assert sval == 7 and evaluate_eq(objective, sol2) == 7
+    # The processes keep their copy of the clauses between requests
+    procs = C.portfolio.procs
+    assert C.sat([(-2,)]) is not None and C.portfolio.procs is procs
+    assert C.synced == len(C.clauses)
+    # The objective is bounded exactly as by the serial minimization
+    C2 = Clauses(10)
+    C2.Require(C2.ExactlyOne, range(1,6))
+    C2.Require(C2.ExactlyOne, range(6,11))
+    C2.minimize(objective, C2.sat())
+    assert C.clauses == C2.clauses and C.m == C2.m
+    # Dead processes are replaced
+    procs[0].terminate()
+    procs[0].join()
+    assert C.sat([(1,), (2,)]) is None and C.portfolio.procs is not procs
+    C.portfolio.close()
+    C.portfolio = None
+    assert all(evaluate_eq(objective, s) == 7 for s in C.itersolve())
+
+def test_minimize_strata():
+    C = Clauses(6)
+    objective = [(8, 1), (8, 2), (1, 3), (3, 4), (2, 5)]
+    strata = C.stratify_(objective)
+    assert strata == [[(8, 1), (8, 2)], [(1, 3), (2, 5), (3, 4)]]
+    objective = [(16, 1), (8, 2), (1, 3), (2, 4), (4, 5)]
+    assert len(C.stratify_(objective)) == 5
+    assert len(C.stratify_([(2, 1), (2, 2), (3, 3)])) == 1
+
+    # Compare against the lexicographic (peak, sum) optimum by brute force
+    import random
+    rng = random.Random(0)
+    for trial in range(30):
+        C = Clauses(8)
+        for _ in range(6):
+            C.Require(C.Any, rng.sample(range(1, 9), 3))
+        objective = [(rng.choice([1, 2, 3, 6, 12, 24, 48]), k) for k in range(1, 9)]
+        odict = {a: c for c, a in objective}
+        best = min((max([0] + [odict.get(s, 0) for s in sol]), evaluate_eq(objective, sol))
+                   for sol in C.itersolve())
+        sol, sval = C.minimize(objective, C.sat())
+        assert sval == best[1] == evaluate_eq(objective, sol), (objective, best, sval)
@@ -914,3 +914,469 @@ def test_update_deps():
         'tk-8.5.13-0.tar.bz2',
         'zlib-1.2.7-0.tar.bz2',
     ]]
+
+def test_unsat_probe_pool():
+    specs = ['numpy 1.5*', 'python 3*', 'scipy', 'nose', 'zlib']
+    r2 = Resolve(index)
+    with pytest.raises(Unsatisfiable) as e1:
+        r2.install(specs)
+    r2.start_probe_pool()
+    try:
+        with pytest.raises(Unsatisfiable) as e2:
+            r2.install(specs)
+    finally:
+        r2.stop_probe_pool()
+    assert str(e1.value) == str(e2.value)
+
+def test_sat_dump_dir():
+    import os
+    import shutil
+    import tempfile
+    from libconda.logic import Clauses
+    dump_dir = tempfile.mkdtemp()
+    os.environ['CONDA_SAT_DUMP_DIR'] = dump_dir
+    try:
+        r.install(['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'])
+        solve_dir, = os.listdir(dump_dir)
+        solve_dir = os.path.join(dump_dir, solve_dir)
+        fns = sorted(os.listdir(solve_dir))
+        assert fns and fns[0] == 'sat0001.cnf'
+        C = Clauses.from_dimacs(os.path.join(solve_dir, fns[0]))
+        assert 'python-2.7.5-0.tar.bz2' in C.sat(names=True)
+    finally:
+        del os.environ['CONDA_SAT_DUMP_DIR']
+        shutil.rmtree(dump_dir)
+
+def test_sat_trace():
+    import json
+    from libconda.logic import SatTrace
+    with SatTrace() as trace:
+        r.install(['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'])
+    records = json.loads(trace.to_json())
+    sats = [rec for rec in records if rec['kind'] == 'sat']
+    assert sats[0]['phase'] == 'satisfiability'
+    assert sats[0]['result'] == 'SAT'
+    assert any(rec['result'] == 'UNSAT' for rec in sats)
+    assert any(rec['phase'] == 'requested versions' for rec in sats)
+    evals = [rec for rec in records if rec['kind'] == 'eval']
+    assert any(rec['phase'] == 'gen_clauses' for rec in evals)
+    assert all(rec['clauses_added'] >= 0 for rec in evals)
+    n = len(trace.records)
+    r.install(['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'])
+    assert len(trace.records) == n
+
+def test_time_budget():
+    from libconda.resolve import SolveTimeout
+    specs = ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*']
+    res = r.install(specs, time_budget=1000)
+    assert res == r.install(specs)
+    assert res.unproven == r.unproven == []
+    assert raises(SolveTimeout, lambda: r.install(specs, time_budget=0))
+
+
+def test_unproven_last_phase():
+    from libconda.resolve import SolveCache
+
+    class LateTimeout(Resolve):
+        # Pretend that the SAT calls of the last pass run out of time
+        def configure_clauses(self, C):
+            super(LateTimeout, self).configure_clauses(C)
+
+            def interrupt():
+                if C.phase == 'alternate solutions':
+                    C.timed_out = True
+            C.interrupt = interrupt
+
+    specs = ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*']
+    r2 = LateTimeout(index, cache=SolveCache())
+    res = r2.install(specs)
+    assert res == r.install(specs)
+    assert res.unproven == ['alternate solutions']
+    # Results that were not proven optimal are not cached
+    assert not any(isinstance(v, list) for v in r2.cache.memory.values())
+
+def test_portfolio():
+    from libconda.logic import Portfolio
+    specs = ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*']
+    r2 = Resolve(index)
+    r2.portfolio = Portfolio(processes=2)
+    try:
+        assert r2.install(specs) == r.install(specs)
+    finally:
+        r2.portfolio.close()
+
+def test_solve_cache():
+    import os
+    import shutil
+    import tempfile
+    from libconda.resolve import SolveCache
+    specs = ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*']
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    expected = r.install(specs, installed)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        r2 = Resolve(index, cache=SolveCache(cache_dir))
+        assert r2.install(specs, installed) == expected
+        key = r2.cache_key('install', sorted(map(r2.spec_key, specs)), sorted(installed),
+                           True, False)
+        assert key in r2.cache.memory
+        assert os.path.isfile(os.path.join(cache_dir, key + '.json'))
+        # A new cache on the same directory finds the entry on disk
+        r3 = Resolve(index, cache=SolveCache(cache_dir))
+        r3.cache.put(key, r3.cache.get(key) + ['bogus-1.0-0.tar.bz2'])
+        r3.cache.memory.clear()
+        # An entry that does not verify is discarded and recomputed
+        assert r3.install(specs, installed) == expected
+        assert r3.cache.get(key) == expected
+        r3.cache.memory[key] = [fn for fn in expected if not fn.startswith('numpy')]
+        assert r3.install(specs, installed) == expected
+        assert r3.install(specs, installed, returnall=True) == [expected]
+        assert r3.cache_key('install', sorted(map(r3.spec_key, specs)), sorted(installed),
+                            True, True) in r3.cache.memory
+        assert r3.remove(['iopro'], expected) == r.remove(['iopro'], expected)
+        # The order of the specs and installed packages does not matter,
+        # and a hit resets the unproven objectives of the last solve
+        nkeys = len(r3.cache.memory)
+        r3.unproven = ['requested versions']
+        res = r3.install(specs[::-1], installed[::-1])
+        assert res == expected and res.unproven == r3.unproven == []
+        assert len(r3.cache.memory) == nkeys
+        # A write that cannot replace an existing entry is dropped
+        from libconda import resolve
+
+        def replace(src, dst):
+            raise OSError('file exists')
+        resolve._replace, old_replace = replace, resolve._replace
+        try:
+            SolveCache(cache_dir).put(key, [])
+        finally:
+            resolve._replace = old_replace
+        assert SolveCache(cache_dir).get(key) == expected
+        assert not [fn for fn in os.listdir(cache_dir) if fn.endswith('.tmp')]
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_solve_many():
+    specs_list = [
+        ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'],
+        ['numpy 1.7*', 'python 3.3*'],
+        ['pandas', 'python 2.6*'],
+        ['numpy 1.5*', 'numpy 1.6*'],
+        ['nonexistent'],
+        ['python 3*', 'anaconda 1.5.0'],
+        [],
+        # Requests with nearly the same packages share their clauses
+        ['numpy 1.7*', 'python 2.7*'],
+        ['numpy 1.7*', 'python 2.7*', 'nose'],
+        ['numpy 1.7*', 'python 2.7*', 'zlib'],
+        # Repeated and fully pinned requests
+        ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'],
+        ['python 2.7.5 0', 'readline 6.2 0', 'sqlite 3.7.13 0', 'system 5.8 1',
+         'tk 8.5.13 0', 'zlib 1.2.7 0', 'openssl 1.0.1c 0'],
+    ]
+    for returnall in (False, True):
+        results = r.solve_many(specs_list, returnall=returnall)
+        assert len(results) == len(specs_list)
+        for specs, res in zip(specs_list, results):
+            if isinstance(res, Exception):
+                with pytest.raises(type(res)) as excinfo:
+                    r.solve(specs, returnall=returnall)
+                assert str(excinfo.value) == str(res)
+            else:
+                assert r.solve(specs, returnall=returnall) == res
+    results = r.solve_many(specs_list)
+    assert isinstance(results[3], Unsatisfiable)
+    assert isinstance(results[4], NoPackagesFound)
+    assert results[6] == []
+
+
+def test_parallel_resolver():
+    import pickle
+    from libconda.resolve import ParallelResolver, SolveTimeout
+    for e in (Unsatisfiable([('numpy 1.5*',), ('numpy 1.6*',)], False),
+              NoPackagesFound([(MatchSpec('nonexistent'),)]), SolveTimeout(1)):
+        e2 = pickle.loads(pickle.dumps(e))
+        assert type(e2) is type(e) and str(e2) == str(e)
+        assert getattr(e2, 'pkgs', None) == getattr(e, 'pkgs', None)
+    specs_list = [
+        ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'],
+        ['numpy 1.5*', 'numpy 1.6*'],
+        ['nonexistent'],
+        ['pandas', 'python 2.6*'],
+    ]
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    with ParallelResolver(r, 2) as pr:
+        results = pr.solve(specs_list, returnall=True)
+        assert [str(x) if isinstance(x, Exception) else x for x in results] == \
+            [str(x) if isinstance(x, Exception) else x for x in r.solve_many(specs_list, True)]
+        assert pr.install([['iopro'], ['scipy']], installed) == \
+            [r.install(['iopro'], installed), r.install(['scipy'], installed)]
+        assert pr.remove([['numpy']], installed) == [r.remove(['numpy'], installed)]
+    assert pr.pool is None
+
+
+def test_solve_profile():
+    import json
+    from libconda.resolve import SolveProfile
+    specs = ['iopro 1.4*', 'python 2.7*', 'numpy 1.7*']
+    profile = SolveProfile()
+    assert r.solve(specs, profile=profile) == r.solve(specs)
+    names = [rec['phase'] for rec in profile.phases]
+    assert names == ['verify_specs', 'prune', 'gen_clauses', 'satisfiability',
+                     'removal count', 'requested versions', 'requested builds',
+                     'track feature count', 'package feature count',
+                     'additional versions', 'additional builds',
+                     'weak dependency count', 'alternate solutions']
+    recs = dict((rec['phase'], rec) for rec in profile.phases)
+    assert recs['prune']['clauses'] is None
+    assert recs['gen_clauses']['clauses'] > 0 and recs['gen_clauses']['vars'] > 0
+    assert recs['gen_clauses']['sat_calls'] == 0
+    assert recs['satisfiability']['sat_calls'] == 1
+    assert recs['requested versions']['objective'] == 0
+    assert all(rec['wall'] >= 0 and rec['cpu'] >= 0 for rec in profile.phases)
+    assert json.loads(profile.to_json()) == profile.phases
+    table = profile.table().splitlines()
+    assert len(table) == len(names) + 2 and table[-1].startswith('total')
+
+    with SolveProfile() as profile:
+        with pytest.raises(Unsatisfiable):
+            r.install(['numpy 1.5*', 'numpy 1.6*'])
+        r.install(['iopro'])
+    names = [rec['phase'] for rec in profile.phases]
+    assert names[:3] == ['verify_specs', 'prune', 'conflict diagnosis']
+    assert names.count('satisfiability') == 1
+
+
+def test_lazy_depends():
+    r2 = Resolve(index)
+    r2.lazy_depends = True
+    for specs in (['iopro 1.4*', 'python 2.7*', 'numpy 1.7*'],
+                  ['anaconda 1.5.0', 'python 2.7*'],
+                  ['pandas', 'python 2.6*'],
+                  ['scipy', 'numpy 1.6*', 'mkl@']):
+        assert r2.solve(specs, returnall=True) == r.solve(specs, returnall=True)
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    assert r2.install(['iopro'], installed) == r.install(['iopro'], installed)
+    assert r2.remove(['numpy'], installed) == r.remove(['numpy'], installed)
+    # Solving lazily needs fewer clauses
+    groups, trackers = build_groups(r.get_dists([MatchSpec('anaconda 1.5.0')])[0])
+    eager = r.gen_clauses(groups, trackers, [])
+    lazy = r.gen_clauses(groups, trackers, [], lazy=True)
+    assert len(lazy.clauses) < len(eager.clauses)
+
+
+def test_solve_hint():
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    for specs in (['iopro'], ['scipy'], ['numpy 1.7*'], ['python 3.3*']):
+        specs2, _ = r.install_specs(specs, installed)
+        assert (r.solve(specs2, len0=len(specs), hint=installed) ==
+                r.solve(specs2, len0=len(specs)))
+    # A hint that conflicts with the specs only affects the starting point
+    assert r.solve(['python 3.3*', 'numpy'], hint=installed) == \
+        r.solve(['python 3.3*', 'numpy'])
+    assert r.solve(['pandas'], hint=['not-a-package-1.0-0.tar.bz2']) == r.solve(['pandas'])
+
+    class SlowPins(Resolve):
+        # Let the first SAT call, with the whole hint pinned, run out of time
+        def configure_clauses(self, C):
+            super(SlowPins, self).configure_clauses(C)
+            calls = []
+
+            def interrupt():
+                C.deadline = None if calls else 0
+                calls.append(1)
+            C.interrupt = interrupt
+
+    r2 = SlowPins(index)
+    installed2 = r.install(['numpy 1.6*', 'python 2.7*', 'yaml'])
+    specs2, _ = r.install_specs(['numpy 1.7*'], installed2)
+    res = r2.solve(specs2, len0=1, hint=installed2)
+    assert res == r.solve(specs2, len0=1) and res.unproven == []
+    # install only passes the installed packages as a hint if asked to
+    r2.warm_start = True
+    assert r2.install(['numpy 1.7*'], installed2) == \
+        r.install(['numpy 1.7*'], installed2)
+
+
+def test_verify_specs_memo():
+    r2 = Resolve(index)
+    res = r2.verify_specs(['numpy', 'scipy', 'pandas'])
+    memo = r2.valid_memo(())
+    assert any(memo.get(fn) for fn in r2.find_matches(MatchSpec('numpy')))
+    assert r2.verify_specs(['numpy', 'scipy', 'pandas']) == res
+    assert r2.valid_memo([]) is memo
+    assert r2.valid_memo(['mkl']) is not memo
+
+    # A cycle of invalid packages is reported without looping
+    index2 = {
+        'package1-1.0-0.tar.bz2': {
+            'build': '0', 'build_number': 0, 'name': 'package1',
+            'depends': ['package2', 'nonexistent'], 'version': '1.0'},
+        'package2-1.0-0.tar.bz2': {
+            'build': '0', 'build_number': 0, 'name': 'package2',
+            'depends': ['package1'], 'version': '1.0'},
+    }
+    r2 = Resolve(index2)
+    with pytest.raises(NoPackagesFound) as excinfo:
+        r2.verify_specs(['package2'])
+    assert 'package2 -> package1 -> nonexistent' in str(excinfo.value)
+
+
+def test_estimate():
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    for specs, inst in ((['numpy'], None), (['anaconda 1.5.0', 'python 2.7*'], None),
+                        (['scipy', 'numpy 1.6*', 'mkl@'], None), (['iopro'], installed),
+                        (['numpy 1.7*'], installed)):
+        est = r.estimate(specs, inst)
+        # The clauses that solve() generates, after merging builds
+        specs = r.install_specs(specs, inst)[0] if inst else list(map(MatchSpec, specs))
+        dists = r.get_dists(specs)[0]
+        dists, merged = r.merge_builds(dists, specs)
+        groups, trackers = build_groups(dists)
+        C = r.gen_clauses(groups, trackers, specs)
+        assert est['ok']
+        assert est['packages'] == len(dists)
+        assert est['groups'] == len(groups)
+        assert est['clauses'] == len(C.clauses)
+        assert est['vars'] == C.m
+    est = r.estimate(['anaconda 1.5.0'], max_group=5, top=2)
+    assert est['largest_groups'] == [['numexpr', 8], ['anaconda', 5]]
+    assert est['version_ranges'][0] == ['python', 3, '2.6.8', '3.3.1']
+    assert est['warnings'] == ['numexpr has 8 candidates and no version pin']
+    assert not r.estimate(['numpy 1.5*', 'scipy 0.12.0b1'])['ok']
+    assert raises(NoPackagesFound, lambda: r.estimate(['notarealpackage 2.0*']))
+
+
+def test_version_order():
+    order = r.version_order('numpy')
+    assert order is r.version_order('numpy')
+    assert set(fn for key, fn in order) == set(r.groups['numpy'])
+    assert all(p[0] >= q[0] for p, q in zip(order, order[1:]))
+    assert r.version_order('notarealpackage') == []
+
+
+def test_merge_builds():
+    index2 = index.copy()
+    fn = 'pandas-0.11.0-np16py27_1.tar.bz2'
+    for k in range(2, 6):
+        index2['%s_%d.tar.bz2' % (fn[:-8], k)] = dict(
+            index[fn], build='np16py27_1_%d' % k, build_number=k)
+    r2 = Resolve(index2)
+    specs = list(map(MatchSpec, ['pandas', 'python 2.7*', 'numpy 1.6*']))
+    dists = r2.get_dists(specs)[0]
+    dists2, merged = r2.merge_builds(dists, specs)
+    assert sorted(merged['pandas-0.11.0-np16py27_1_5.tar.bz2']) == [
+        'pandas-0.11.0-np16py27_1.tar.bz2', 'pandas-0.11.0-np16py27_1_2.tar.bz2',
+        'pandas-0.11.0-np16py27_1_3.tar.bz2', 'pandas-0.11.0-np16py27_1_4.tar.bz2']
+    assert len(dists2) < len(dists)
+    res = r2.solve(specs, returnall=True)
+    assert len(res) == 1
+    assert 'pandas-0.11.0-np16py27_1_5.tar.bz2' in res[0]
+    # A spec that tells the builds apart keeps them separate
+    specs.append(MatchSpec('pandas 0.11.0 np16py27_1'))
+    merged = r2.merge_builds(dists, specs)[1]
+    assert 'pandas-0.11.0-np16py27_1.tar.bz2' not in merged['pandas-0.11.0-np16py27_1_5.tar.bz2']
+    # and a target keeps all the builds of its package
+    specs[-1] = MatchSpec('pandas', target='pandas-0.11.0-np16py27_1_2.tar.bz2')
+    merged = r2.merge_builds(dists, specs)[1]
+    assert not any(r2.package_name(fn) == 'pandas' for fn in merged)
+    # An update_deps install upgrades to the nearest build, as without merging
+    installed = r.install(['python 2.6.8 6'])
+    res = r.install(['six 1.2.0 py27_0'], installed)
+    assert 'python-2.7.3-2.tar.bz2' in res
+
+
+def test_feature_sets():
+    fn1, fn2 = 'numpy-1.7.1-py27_p0.tar.bz2', 'numpy-1.6.2-py27_p4.tar.bz2'
+    assert r.features(fn1) == {'mkl'}
+    assert r.features_[fn1] is r.features_[fn2]
+    # The public methods return copies that callers may change
+    r.features(fn1).add('debug')
+    assert r.features(fn1) == {'mkl'}
+    assert r.track_features('mkl@') == {'mkl'}
+    assert r.features('numpy-1.7.1-py27_0.tar.bz2') == set()
+
+
+def test_solve_interrupt():
+    from libconda.resolve import SolveCancelled
+    r2 = Resolve(index)
+    calls = []
+
+    def interrupt():
+        calls.append(None)
+        if len(calls) > 3:
+            raise SolveCancelled()
+    r2.interrupt = interrupt
+    assert raises(SolveCancelled, lambda: r2.solve(['anaconda 1.5.0', 'python 2.7*']))
+    assert len(calls) == 4
+    r2.interrupt = None
+    assert r2.solve(['anaconda 1.5.0', 'python 2.7*']) == r.solve(['anaconda 1.5.0', 'python 2.7*'])
+
+
+def test_async_resolver():
+    import threading
+    from libconda import resolve
+    from libconda.resolve import AsyncResolver, SolveCancelled
+    asyncio = pytest.importorskip('asyncio')
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    phases = []
+    loop = asyncio.new_event_loop()
+    try:
+        with AsyncResolver(r, 2) as ar:
+            futs = [ar.asolve(['pandas', 'python 2.6*'], progress=phases.append, loop=loop),
+                    ar.ainstall(['iopro'], installed, loop=loop),
+                    ar.aremove(['numpy'], installed, loop=loop),
+                    ar.asolve(['nonexistent'], loop=loop)]
+            results = [loop.run_until_complete(fut) for fut in futs[:3]]
+            assert raises(NoPackagesFound, lambda: loop.run_until_complete(futs[3]))
+    finally:
+        loop.close()
+    assert results == [r.solve(['pandas', 'python 2.6*']), r.install(['iopro'], installed),
+                       r.remove(['numpy'], installed)]
+    assert phases[:3] == ['verify_specs', 'prune', 'gen_clauses']
+    assert phases[-1] == 'alternate solutions'
+
+    # A cancelled request stops at the start of the next phase
+    cancel = threading.Event()
+    cancel.set()
+    resolve._init_worker(Resolve(index))
+    try:
+        assert raises(SolveCancelled, lambda: resolve._run_async_request(
+            ('solve', (['numpy'],), {}, 1, cancel, None)))
+    finally:
+        resolve._init_worker(None)
+
+
+def test_consistent():
+    from libconda.resolve import SolveCache
+    r2 = Resolve(index, cache=SolveCache())
+    installed = r.install(['numpy 1.6*', 'python 2.7*'])
+    assert r2.consistent(installed)
+    assert r2.consistent_[frozenset(installed)] is True
+    broken = [fn for fn in installed if not fn.startswith('python-')]
+    assert not r2.consistent(broken)
+    assert not r2.consistent(installed + ['python-3.3.2-0.tar.bz2'])
+    # An entry in the persistent cache is never trusted
+    r3 = Resolve(index, cache=r2.cache)
+    r3.cache.put(r3.cache_key('consistent', sorted(broken)), True)
+    assert not r3.consistent(broken)
+    assert r3.bad_installed(broken, [])[0] is not None
+
+
+def test_pinned():
+    installed = r.install(['anaconda 1.5.0 np17py27_0'])
+    specs = [MatchSpec(' '.join(r.package_triple(fn))) for fn in installed]
+    assert r.pinned(specs) == installed
+    assert r.solve(specs) == installed
+    assert r.solve(specs, returnall=True) == [installed]
+    # Loose specs for pinned names are checked against the pins
+    assert r.pinned(specs + [MatchSpec('python 2.7*')]) == installed
+    assert r.pinned(specs + [MatchSpec('python 3*')]) is None
+    # Anything else is left to the SAT solver
+    assert r.pinned(specs + [MatchSpec('mkl')]) is None
+    assert r.pinned([ms for ms in specs if ms.name != 'python']) is None
+    assert r.pinned([MatchSpec('numpy')]) is None
+    conflict = [MatchSpec('numpy 1.7.1 py27_0'), MatchSpec('python 3.3.2 0')]
+    assert r.pinned(conflict) is None
+    assert raises(Unsatisfiable, lambda: r.solve(conflict))